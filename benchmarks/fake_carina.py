@@ -0,0 +1,533 @@
+"""
+A local stand-in for the Carina OAuth and cluster API, and the Docker API of each cluster
+
+Carina was retired, so this is the only way to exercise CarinaOAuthClient and CarinaSpawner
+end to end. Each API call can be slowed down, new clusters only return their credentials
+once they are ready, access tokens expire and valid tokens can be randomly rejected.
+
+Run it on its own to point a hub at it:
+
+    python benchmarks/fake_carina.py --port 8000 --ready-after 10
+"""
+import argparse
+from collections import Counter
+import io
+import json
+import os
+import random
+import ssl
+import subprocess
+import tempfile
+import threading
+from time import time
+from uuid import uuid4
+from zipfile import ZipFile
+from tornado import gen, web
+from tornado.httpserver import HTTPServer
+from tornado.ioloop import IOLoop
+from tornado.netutil import bind_sockets
+
+DOCKER_API_VERSION = '1.24'
+DOCKER_VERSION = '1.12.1'
+
+
+def generate_certificates(directory):
+    """
+    Create a CA, and a server and client certificate signed by it, with openssl
+
+    Returns the paths of ca.pem, server-cert.pem, server-key.pem, cert.pem and key.pem
+    """
+    paths = {name: os.path.join(directory, name) for name in
+             ('ca.pem', 'ca-key.pem', 'server-cert.pem', 'server-key.pem', 'cert.pem', 'key.pem')}
+    extensions = os.path.join(directory, 'extensions.cnf')
+    with open(extensions, 'w') as f:
+        f.write("basicConstraints=CA:FALSE\n"
+                "subjectAltName=IP:127.0.0.1,DNS:localhost\n"
+                "extendedKeyUsage=serverAuth,clientAuth\n")
+
+    def openssl(*args):
+        subprocess.check_call(('openssl',) + args, stdout=subprocess.DEVNULL,
+                              stderr=subprocess.DEVNULL)
+
+    openssl('req', '-x509', '-newkey', 'ec', '-pkeyopt', 'ec_paramgen_curve:prime256v1',
+            '-nodes', '-days', '30', '-subj', '/CN=fake-carina-ca',
+            '-keyout', paths['ca-key.pem'], '-out', paths['ca.pem'])
+    for name, cert, key in (('fake-carina-swarm', 'server-cert.pem', 'server-key.pem'),
+                            ('fake-carina-client', 'cert.pem', 'key.pem')):
+        csr = os.path.join(directory, name + '.csr')
+        openssl('req', '-new', '-newkey', 'ec', '-pkeyopt', 'ec_paramgen_curve:prime256v1',
+                '-nodes', '-subj', '/CN=' + name, '-keyout', paths[key], '-out', csr)
+        openssl('x509', '-req', '-in', csr, '-CA', paths['ca.pem'], '-CAkey', paths['ca-key.pem'],
+                '-CAcreateserial', '-days', '30', '-extfile', extensions, '-out', paths[cert])
+
+    return paths
+
+
+class FakeCarina:
+    """
+    The state of the fake Carina service: users, tokens, clusters and the calls made to it
+    """
+
+    def __init__(self, latency=0.05, ready_after=5.0, token_ttl=3600, reject_rate=0.0,
+                 error_rate=0.0, docker_latency=0.01, pull_duration=1.0, pull_layers=3):
+        self.latency = latency
+        self.ready_after = ready_after
+        self.token_ttl = token_ttl
+        self.reject_rate = reject_rate
+        self.error_rate = error_rate
+        self.docker_latency = docker_latency
+        self.pull_duration = pull_duration
+        self.pull_layers = pull_layers
+
+        # access token -> (user, expires at)
+        self.access_tokens = {}
+        # refresh token -> user, refresh tokens can only be used once
+        self.refresh_tokens = {}
+        # user -> {cluster name: cluster}
+        self.clusters = {}
+        # cluster id -> FakeSwarm
+        self.swarms = {}
+        # (method, endpoint) -> number of calls
+        self.calls = Counter()
+        self.docker_calls = Counter()
+
+        self.certs_dir = tempfile.mkdtemp(prefix='fake-carina-')
+        self.certs = generate_certificates(self.certs_dir)
+        self.ssl_context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH,
+                                                      cafile=self.certs['ca.pem'])
+        self.ssl_context.load_cert_chain(self.certs['server-cert.pem'],
+                                         self.certs['server-key.pem'])
+        self.ssl_context.verify_mode = ssl.CERT_REQUIRED
+
+        self.url = None
+
+    def listen(self, port=0, address='127.0.0.1'):
+        """
+        Serve the Carina API
+        Returns its URL
+        """
+        sockets = bind_sockets(port, address)
+        HTTPServer(self.make_app()).add_sockets(sockets)
+        self.url = 'http://{}:{}'.format(address, sockets[0].getsockname()[1])
+        return self.url
+
+    def listen_in_thread(self, port=0, address='127.0.0.1'):
+        """
+        Serve the Carina API, and the Docker API of each cluster, from a separate IO loop
+        so that blocking calls made by the hub do not block the fake service
+        Returns its URL
+        """
+        ready = threading.Event()
+
+        def serve():
+            loop = IOLoop()
+            loop.make_current()
+            self.listen(port, address)
+            ready.set()
+            loop.start()
+
+        threading.Thread(target=serve, name='fake-carina', daemon=True).start()
+        ready.wait()
+        return self.url
+
+    def make_app(self):
+        return web.Application([
+            (r'/oauth/token', TokenHandler, {'carina': self}),
+            (r'/users/current', ProfileHandler, {'carina': self}),
+            (r'/proxy/cluster_types', ClusterTypesHandler, {'carina': self}),
+            (r'/proxy/clusters', ClustersHandler, {'carina': self}),
+            (r'/proxy/clusters/([^/]+)/credentials/zip', CredentialsHandler, {'carina': self}),
+            (r'/proxy/clusters/([^/]+)', ClusterHandler, {'carina': self}),
+        ])
+
+    def issue_tokens(self, user):
+        access_token = uuid4().hex
+        refresh_token = uuid4().hex
+        self.access_tokens[access_token] = (user, time() + self.token_ttl)
+        self.refresh_tokens[refresh_token] = user
+        return {
+            'access_token': access_token,
+            'refresh_token': refresh_token,
+            'expires_in': self.token_ttl,
+            'token_type': 'bearer',
+        }
+
+    def create_cluster(self, user, name):
+        cluster = {
+            'id': uuid4().hex,
+            'name': name,
+            'node_count': 1,
+            'created': time(),
+        }
+        self.clusters.setdefault(user, {})[name] = cluster
+        return cluster
+
+    def describe_cluster(self, cluster):
+        status = 'active' if time() - cluster['created'] >= self.ready_after else 'building'
+        return dict(cluster, status=status)
+
+    def find_cluster(self, user, cluster_id):
+        for cluster in self.clusters.get(user, {}).values():
+            if cluster['id'] == cluster_id:
+                return cluster
+        return None
+
+    def swarm(self, cluster):
+        """
+        Start the Docker API of a cluster, on its own port
+        """
+        swarm = self.swarms.get(cluster['id'])
+        if swarm is None:
+            swarm = self.swarms[cluster['id']] = FakeSwarm(self, cluster)
+        return swarm
+
+    def credentials_zip(self, cluster):
+        swarm = self.swarm(cluster)
+        buffer = io.BytesIO()
+        with ZipFile(buffer, 'w') as credentials:
+            folder = cluster['name']
+            credentials.writestr(os.path.join(folder, 'docker.env'),
+                                 'export DOCKER_HOST=tcp://{}\n'
+                                 'export DOCKER_TLS_VERIFY=1\n'
+                                 'export DOCKER_CERT_PATH=$(pwd)\n'
+                                 'export DOCKER_VERSION={}\n'.format(swarm.address, DOCKER_VERSION))
+            for name in ('ca.pem', 'cert.pem', 'key.pem'):
+                credentials.write(self.certs[name], os.path.join(folder, name))
+        return buffer.getvalue()
+
+    def stats(self):
+        return {
+            'users': len(self.clusters),
+            'clusters': sum(len(clusters) for clusters in self.clusters.values()),
+            'calls': dict(('{} {}'.format(*key), count) for key, count in self.calls.items()),
+            'docker_calls': dict(('{} {}'.format(*key), count)
+                                 for key, count in self.docker_calls.items()),
+        }
+
+
+class CarinaHandler(web.RequestHandler):
+    """
+    Counts each call, adds latency and checks the OAuth access token
+    """
+
+    endpoint = None
+    authenticated = True
+
+    def initialize(self, carina):
+        self.carina = carina
+        self.user = None
+
+    @gen.coroutine
+    def prepare(self):
+        self.carina.calls[(self.request.method, self.endpoint)] += 1
+        if self.carina.latency:
+            yield gen.sleep(self.carina.latency)
+        if random.random() < self.carina.error_rate:
+            raise web.HTTPError(503, 'The service is temporarily unavailable')
+
+        if not self.authenticated:
+            return
+
+        header = self.request.headers.get('Authorization', '')
+        token = header.split(' ', 1)[-1]
+        user, expires_at = self.carina.access_tokens.get(token, (None, 0))
+        if user is None or time() >= expires_at:
+            raise web.HTTPError(401, 'The access token is invalid or expired')
+        if random.random() < self.carina.reject_rate:
+            raise web.HTTPError(401, 'The access token was rejected')
+        self.user = user
+
+    def write_error(self, status_code, **kwargs):
+        self.finish({'error': self._reason})
+
+
+class TokenHandler(CarinaHandler):
+    endpoint = '/oauth/token'
+    authenticated = False
+
+    def post(self):
+        grant_type = self.get_body_argument('grant_type')
+        if grant_type == 'authorization_code':
+            # The fake authorization code is the username
+            user = self.get_body_argument('code')
+        elif grant_type == 'refresh_token':
+            user = self.carina.refresh_tokens.pop(self.get_body_argument('refresh_token'), None)
+            if user is None:
+                raise web.HTTPError(401, 'The refresh token is invalid')
+        else:
+            raise web.HTTPError(400, 'Unsupported grant type')
+
+        self.write(self.carina.issue_tokens(user))
+
+
+class ProfileHandler(CarinaHandler):
+    endpoint = '/users/current'
+
+    def get(self):
+        self.write({'username': self.user})
+
+
+class ClusterTypesHandler(CarinaHandler):
+    endpoint = '/proxy/cluster_types'
+
+    def get(self):
+        self.write({'cluster_types': [
+            {'id': 1, 'coe': 'swarm', 'name': 'Docker Swarm 1.11'},
+            {'id': 2, 'coe': 'kubernetes', 'name': 'Kubernetes 1.4'},
+            {'id': 3, 'coe': 'swarm', 'name': 'Docker Swarm 1.12'},
+        ]})
+
+
+class ClustersHandler(CarinaHandler):
+    endpoint = '/proxy/clusters'
+
+    def get(self):
+        clusters = self.carina.clusters.get(self.user, {}).values()
+        self.write({'clusters': [self.carina.describe_cluster(cluster) for cluster in clusters]})
+
+    def post(self):
+        body = json.loads(self.request.body.decode('utf8'))
+        if body['name'] in self.carina.clusters.get(self.user, {}):
+            raise web.HTTPError(409, 'A cluster with that name already exists')
+        cluster = self.carina.create_cluster(self.user, body['name'])
+        if random.random() < self.carina.error_rate:
+            # The cluster was created, but the response was lost
+            raise web.HTTPError(504, 'The upstream server timed out')
+        self.set_status(201)
+        self.write(self.carina.describe_cluster(cluster))
+
+
+class ClusterHandler(CarinaHandler):
+    endpoint = '/proxy/clusters/:id'
+
+    def delete(self, cluster_id):
+        cluster = self.carina.find_cluster(self.user, cluster_id)
+        if cluster is None:
+            raise web.HTTPError(404, 'Cluster not found')
+        del self.carina.clusters[self.user][cluster['name']]
+        self.set_status(204)
+
+
+class CredentialsHandler(CarinaHandler):
+    endpoint = '/proxy/clusters/:id/credentials/zip'
+
+    def get(self, cluster_id):
+        cluster = self.carina.find_cluster(self.user, cluster_id)
+        if cluster is None:
+            raise web.HTTPError(404, 'Cluster not found')
+        if self.carina.describe_cluster(cluster)['status'] != 'active':
+            self.set_status(404)
+            self.finish('Cluster credentials do not exist')
+            return
+
+        self.set_header('Content-Type', 'application/zip')
+        self.write(self.carina.credentials_zip(cluster))
+
+
+class FakeSwarm:
+    """
+    The Docker API of a single fake cluster, served with TLS client authentication
+    """
+
+    def __init__(self, carina, cluster):
+        self.carina = carina
+        self.cluster = cluster
+        # image -> digest
+        self.images = {}
+        # container id -> container
+        self.containers = {}
+
+        sockets = bind_sockets(0, '127.0.0.1')
+        HTTPServer(self.make_app(), ssl_options=carina.ssl_context).add_sockets(sockets)
+        self.address = '127.0.0.1:{}'.format(sockets[0].getsockname()[1])
+
+    def make_app(self):
+        version = r'(?:/v[0-9.]+)?'
+        kwargs = {'swarm': self}
+        return web.Application([
+            (version + r'/_ping', PingHandler, kwargs),
+            (version + r'/version', VersionHandler, kwargs),
+            (version + r'/info', InfoHandler, kwargs),
+            (version + r'/images/create', PullHandler, kwargs),
+            (version + r'/images/(.+)/json', ImageHandler, kwargs),
+            (version + r'/containers/create', CreateContainerHandler, kwargs),
+            (version + r'/containers/([^/]+)/json', ContainerHandler, kwargs),
+            (version + r'/containers/([^/]+)/(start|stop)', ContainerActionHandler, kwargs),
+            (version + r'/containers/([^/]+)', ContainerHandler, kwargs),
+        ])
+
+    def find_container(self, id_or_name):
+        name = '/' + id_or_name
+        for container in self.containers.values():
+            if container['Id'].startswith(id_or_name) or container['Name'] == name:
+                return container
+        raise web.HTTPError(404, 'No such container: ' + id_or_name)
+
+
+class DockerHandler(web.RequestHandler):
+    endpoint = None
+
+    def initialize(self, swarm):
+        self.swarm = swarm
+        self.carina = swarm.carina
+
+    @gen.coroutine
+    def prepare(self):
+        self.carina.docker_calls[(self.request.method, self.endpoint)] += 1
+        if self.carina.docker_latency:
+            yield gen.sleep(self.carina.docker_latency)
+
+    def write_error(self, status_code, **kwargs):
+        self.finish({'message': self._reason})
+
+
+class PingHandler(DockerHandler):
+    endpoint = '/_ping'
+
+    def get(self):
+        self.set_header('Content-Type', 'text/plain')
+        self.write('OK')
+
+
+class VersionHandler(DockerHandler):
+    endpoint = '/version'
+
+    def get(self):
+        self.write({'Version': DOCKER_VERSION, 'ApiVersion': DOCKER_API_VERSION})
+
+
+class InfoHandler(DockerHandler):
+    endpoint = '/info'
+
+    def get(self):
+        self.write({'Containers': len(self.swarm.containers), 'Images': len(self.swarm.images),
+                    'ServerVersion': 'swarm/1.2.5'})
+
+
+class PullHandler(DockerHandler):
+    endpoint = '/images/create'
+
+    @gen.coroutine
+    def post(self):
+        image = self.get_query_argument('fromImage')
+        tag = self.get_query_argument('tag', 'latest') or 'latest'
+        layers = [uuid4().hex[:12] for _ in range(self.carina.pull_layers)]
+        step = self.carina.pull_duration / (2 * len(layers)) if layers else 0
+        layer_size = 50 * 1000 * 1000
+
+        self.set_header('Content-Type', 'application/json')
+        self.send_event({'status': 'Pulling from ' + image, 'id': tag})
+        for layer in layers:
+            self.send_event({'status': 'Pulling fs layer', 'id': layer})
+        for layer in layers:
+            for current in (layer_size // 2, layer_size):
+                yield gen.sleep(step)
+                self.send_event({'status': 'Downloading', 'id': layer,
+                                 'progressDetail': {'current': current, 'total': layer_size}})
+                yield self.flush()
+            self.send_event({'status': 'Pull complete', 'id': layer})
+
+        digest = 'sha256:' + uuid4().hex * 2
+        self.swarm.images['{}:{}'.format(image, tag)] = digest
+        self.send_event({'status': 'Digest: ' + digest})
+        self.send_event({'status': 'Status: Downloaded newer image for {}:{}'.format(image, tag)})
+
+    def send_event(self, event):
+        self.write(json.dumps(event) + '\r\n')
+
+
+class ImageHandler(DockerHandler):
+    endpoint = '/images/:name/json'
+
+    def get(self, name):
+        if ':' not in name.rsplit('/', 1)[-1]:
+            name += ':latest'
+        digest = self.swarm.images.get(name)
+        if digest is None:
+            raise web.HTTPError(404, 'No such image: ' + name)
+
+        repository = name.rsplit(':', 1)[0]
+        self.write({'Id': digest, 'RepoTags': [name],
+                    'RepoDigests': ['{}@{}'.format(repository, digest)]})
+
+
+class CreateContainerHandler(DockerHandler):
+    endpoint = '/containers/create'
+
+    def post(self):
+        config = json.loads(self.request.body.decode('utf8'))
+        name = self.get_query_argument('name', uuid4().hex[:12])
+        for container in self.swarm.containers.values():
+            if container['Name'] == '/' + name:
+                raise web.HTTPError(409, 'Conflict. The name {} is already in use'.format(name))
+
+        container_id = uuid4().hex * 2
+        self.swarm.containers[container_id] = {
+            'Id': container_id,
+            'Name': '/' + name,
+            'Config': {'Image': config.get('Image'), 'Env': config.get('Env') or []},
+            'State': {'Running': False, 'ExitCode': 0, 'Error': '', 'FinishedAt': ''},
+            'NetworkSettings': {'IPAddress': '', 'Ports': {}},
+        }
+        self.set_status(201)
+        self.write({'Id': container_id, 'Warnings': None})
+
+
+class ContainerHandler(DockerHandler):
+    endpoint = '/containers/:id'
+
+    def get(self, container_id):
+        self.write(self.swarm.find_container(container_id))
+
+    def delete(self, container_id):
+        container = self.swarm.find_container(container_id)
+        del self.swarm.containers[container['Id']]
+        self.set_status(204)
+
+
+class ContainerActionHandler(DockerHandler):
+    endpoint = '/containers/:id/:action'
+
+    def post(self, container_id, action):
+        container = self.swarm.find_container(container_id)
+        if action == 'start':
+            container['State']['Running'] = True
+            container['NetworkSettings'] = {
+                'IPAddress': '10.0.0.2',
+                'Ports': {'8888/tcp': [{'HostIp': '127.0.0.1',
+                                        'HostPort': str(random.randint(32768, 60999))}]},
+            }
+        else:
+            container['State'].update(Running=False, FinishedAt=str(time()))
+            container['NetworkSettings']['Ports'] = {}
+        self.set_status(204)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--latency', type=float, default=0.05,
+                        help="Seconds added to each Carina API call")
+    parser.add_argument('--ready-after', type=float, default=5,
+                        help="Seconds before a new cluster's credentials are available")
+    parser.add_argument('--token-ttl', type=int, default=3600,
+                        help="Seconds before an access token expires")
+    parser.add_argument('--reject-rate', type=float, default=0,
+                        help="The fraction of valid access tokens which are rejected with a 401")
+    parser.add_argument('--error-rate', type=float, default=0,
+                        help="The fraction of API calls which fail with a 503, and of cluster "
+                             "creations which fail with a 504 after creating the cluster")
+    parser.add_argument('--pull-duration', type=float, default=1,
+                        help="Seconds taken to pull an image")
+    args = parser.parse_args()
+
+    carina = FakeCarina(latency=args.latency, ready_after=args.ready_after,
+                        token_ttl=args.token_ttl, reject_rate=args.reject_rate,
+                        error_rate=args.error_rate, pull_duration=args.pull_duration)
+    print("Serving the fake Carina API at", carina.listen(args.port))
+    print("Set CARINA_OAUTH_URL={} when running the hub".format(carina.url))
+    IOLoop.current().start()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,240 @@
+"""
+Drive concurrent logins and server starts against the fake Carina API
+
+Each simulated user completes the OAuth callback with CarinaAuthenticator.authenticate and then
+starts their server with CarinaSpawner.start, on a new cluster. The throughput, the latency
+percentiles of each flow and the API calls made per spawn are reported.
+
+    python benchmarks/spawn_benchmark.py --users 50 --concurrency 10 --ready-after 5
+"""
+import argparse
+import json
+import logging
+import os
+import shutil
+import sys
+import tempfile
+from collections import Counter
+from time import time
+from types import SimpleNamespace
+from tornado import gen
+from tornado.ioloop import IOLoop
+from tornado.locks import Semaphore
+from traitlets.config import Config
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from fake_carina import FakeCarina
+
+
+def percentile(values, percent):
+    if not values:
+        return 0
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(percent / 100 * (len(values) - 1))))
+    return values[index]
+
+
+def make_config(args, credentials_root):
+    c = Config()
+    c.CarinaAuthenticator.client_id = 'benchmark'
+    c.CarinaAuthenticator.client_secret = 'benchmark'
+    c.CarinaAuthenticator.oauth_callback_url = 'http://127.0.0.1:8000/hub/oauth_callback'
+    c.CarinaSpawner.credentials_root = credentials_root
+    c.CarinaSpawner.container_image = 'jupyter/singleuser'
+    c.CarinaSpawner.cluster_polling_interval = args.polling_interval
+    c.CarinaSpawner.async_docker = args.async_docker
+    c.CarinaSpawner.image_pull_report_interval = 1
+    c.BackoffReadiness.initial_interval = min(0.5, args.polling_interval)
+    c.CarinaOAuthClient.http_backend = args.http_backend
+    c.CarinaOAuthClient.max_clients = args.max_clients
+    c.CarinaAdmission.max_concurrent_spawns = args.max_concurrent_spawns
+    c.CarinaAdmission.api_rate = args.api_rate
+    c.CarinaAdmission.pull_rate = args.pull_rate
+    if args.trace:
+        c.CarinaTracer.enabled = True
+        c.CarinaTracer.path = args.trace
+    return c
+
+
+async def watch_progress(spawner):
+    """
+    Collect the progress events of a spawn, like the spawn pending page
+    """
+    return [event async for event in spawner.progress()]
+
+
+@gen.coroutine
+def spawn(number, authenticator, config, semaphore, results):
+    """
+    Log a user in and start their server
+    """
+    from jupyterhub_carina import CarinaSpawner
+
+    name = 'user{:04d}'.format(number)
+    with (yield semaphore.acquire()):
+        result = {'user': name, 'started': time()}
+        results.append(result)
+        try:
+            handler = SimpleNamespace(get_argument=lambda argument, default=None: name)
+            username = yield authenticator.authenticate(handler)
+            result['authenticated'] = time() - result['started']
+
+            user = SimpleNamespace(
+                name=username,
+                state={},
+                url='/user/{}/'.format(name),
+                server=SimpleNamespace(ip='', port=0, cookie_name='jupyter-hub-token-' + name,
+                                       base_url='/user/{}/'.format(name)))
+            hub = SimpleNamespace(api_url='http://127.0.0.1:8081/hub/api', public_host='',
+                                  base_url='/hub/', server=SimpleNamespace(base_url='/hub/'))
+            spawner = CarinaSpawner(user=user, hub=hub, authenticator=authenticator,
+                                    config=config, api_token='benchmark')
+            # JupyterHub 0.9 looks the server up on the spawner
+            spawner.server = user.server
+            yield authenticator.pre_spawn_start(user, spawner)
+            started = spawner.start()
+            events = yield watch_progress(spawner)
+            yield started
+
+            result['stages'] = dict(spawner.stage_timings)
+            result['progress'] = events
+        except Exception as e:
+            result['error'] = '{}: {}'.format(type(e).__name__, e)
+        result['duration'] = time() - result['started']
+
+
+@gen.coroutine
+def run(args):
+    carina = FakeCarina(latency=args.latency, ready_after=args.ready_after,
+                        token_ttl=args.token_ttl, reject_rate=args.reject_rate,
+                        error_rate=args.error_rate, docker_latency=args.docker_latency, pull_duration=args.pull_duration)
+    os.environ['CARINA_OAUTH_URL'] = carina.listen_in_thread()
+
+    # The API URLs are read when the package is imported
+    from jupyterhub_carina import CarinaAuthenticator
+
+    credentials_root = tempfile.mkdtemp(prefix='carina-benchmark-')
+    try:
+        config = make_config(args, credentials_root)
+        authenticator = CarinaAuthenticator(config=config)
+        semaphore = Semaphore(args.concurrency)
+        results = []
+
+        started = time()
+        yield [spawn(number, authenticator, config, semaphore, results)
+               for number in range(args.users)]
+        duration = time() - started
+    finally:
+        shutil.rmtree(credentials_root, ignore_errors=True)
+        shutil.rmtree(carina.certs_dir, ignore_errors=True)
+
+    return summarize(args, results, duration, carina)
+
+
+def summarize(args, results, duration, carina):
+    succeeded = [result for result in results if 'error' not in result]
+    latencies = [result['duration'] for result in succeeded]
+    stages = {}
+    for result in succeeded:
+        for stage, seconds in result['stages'].items():
+            stages.setdefault(stage, []).append(seconds)
+
+    stats = carina.stats()
+    spawns = max(len(results), 1)
+    return {
+        'users': args.users,
+        'concurrency': args.concurrency,
+        'succeeded': len(succeeded),
+        'failed': len(results) - len(succeeded),
+        'errors': dict(Counter(result['error'] for result in results if 'error' in result)),
+        'duration': duration,
+        'throughput': len(succeeded) / duration if duration else 0,
+        'latency': {
+            'p50': percentile(latencies, 50),
+            'p90': percentile(latencies, 90),
+            'p99': percentile(latencies, 99),
+            'max': max(latencies) if latencies else 0,
+        },
+        'stages': {stage: {'p50': percentile(seconds, 50), 'p99': percentile(seconds, 99)}
+                   for stage, seconds in stages.items()},
+        'api_calls_per_spawn': sum(stats['calls'].values()) / spawns,
+        'progress_events_per_spawn': sum(len(result['progress']) for result in succeeded) /
+                                     max(len(succeeded), 1),
+        'progress_messages': [event['message'] for event in succeeded[0]['progress']]
+                             if succeeded else [],
+        'docker_calls_per_spawn': sum(stats['docker_calls'].values()) / spawns,
+        'api_calls': stats['calls'],
+        'docker_calls': stats['docker_calls'],
+    }
+
+
+def report(summary):
+    print("{succeeded}/{users} spawns succeeded in {duration:.1f}s ({throughput:.2f}/s), "
+          "concurrency {concurrency}".format(**summary))
+    print("Latency: p50 {p50:.2f}s, p90 {p90:.2f}s, p99 {p99:.2f}s, max {max:.2f}s"
+          .format(**summary['latency']))
+    for stage, seconds in summary['stages'].items():
+        print("  {:<12} p50 {:.2f}s, p99 {:.2f}s".format(stage, seconds['p50'], seconds['p99']))
+    print("Carina API calls per spawn: {:.1f}".format(summary['api_calls_per_spawn']))
+    for endpoint, count in sorted(summary['api_calls'].items()):
+        print("  {:<45} {}".format(endpoint, count))
+    print("Docker API calls per spawn: {:.1f}".format(summary['docker_calls_per_spawn']))
+    for endpoint, count in sorted(summary['docker_calls'].items()):
+        print("  {:<45} {}".format(endpoint, count))
+    print("Progress events per spawn: {:.1f}".format(summary['progress_events_per_spawn']))
+    for message in summary['progress_messages']:
+        print("  " + message)
+    for error, count in summary['errors'].items():
+        print("Failed {} times: {}".format(count, error))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--users', type=int, default=20)
+    parser.add_argument('--concurrency', type=int, default=10)
+    parser.add_argument('--latency', type=float, default=0.05,
+                        help="Seconds added to each Carina API call")
+    parser.add_argument('--docker-latency', type=float, default=0.01,
+                        help="Seconds added to each Docker API call")
+    parser.add_argument('--ready-after', type=float, default=2,
+                        help="Seconds before a new cluster's credentials are available")
+    parser.add_argument('--token-ttl', type=int, default=3600,
+                        help="Seconds before an access token expires")
+    parser.add_argument('--reject-rate', type=float, default=0,
+                        help="The fraction of valid access tokens which are rejected with a 401")
+    parser.add_argument('--error-rate', type=float, default=0,
+                        help="The fraction of API calls which fail with a 503, and of cluster "
+                             "creations which fail with a 504 after creating the cluster")
+    parser.add_argument('--pull-duration', type=float, default=1,
+                        help="Seconds taken to pull an image")
+    parser.add_argument('--polling-interval', type=float, default=5,
+                        help="CarinaSpawner.cluster_polling_interval")
+    parser.add_argument('--async-docker', action='store_true',
+                        help="Enable CarinaSpawner.async_docker")
+    parser.add_argument('--http-backend', choices=['curl', 'simple'], default='simple',
+                        help="CarinaOAuthClient.http_backend")
+    parser.add_argument('--max-clients', type=int, default=50,
+                        help="CarinaOAuthClient.max_clients")
+    parser.add_argument('--max-concurrent-spawns', type=int, default=0,
+                        help="CarinaAdmission.max_concurrent_spawns")
+    parser.add_argument('--api-rate', type=float, default=0,
+                        help="CarinaAdmission.api_rate")
+    parser.add_argument('--pull-rate', type=float, default=0,
+                        help="CarinaAdmission.pull_rate")
+    parser.add_argument('--trace', metavar='PATH',
+                        help="Write a trace of each login and spawn to a JSON lines file")
+    parser.add_argument('--json', action='store_true', help="Print the results as JSON")
+    parser.add_argument('--log-level', default='WARNING')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=args.log_level)
+    summary = IOLoop.current().run_sync(lambda: run(args))
+    if args.json:
+        print(json.dumps(summary, indent=2, sort_keys=True))
+    else:
+        report(summary)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,170 @@
+from collections import deque
+from time import time
+from tornado.concurrent import Future
+from traitlets import Float, Integer
+from traitlets.config import SingletonConfigurable
+from . import CarinaMetrics as metrics
+
+
+class SpawnCancelled(Exception):
+    """
+    Raised when a queued spawn is cancelled before it started
+    """
+    pass
+
+
+class TokenBucket:
+    """
+    Limits the rate of an operation, while allowing short bursts
+
+    Callers reserve a token and wait until it is theirs, so they are served in the order that
+    they arrived.
+    """
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.tokens = self.burst
+        self.updated = time()
+
+    def reserve(self):
+        """
+        Reserve a token
+        Returns the number of seconds to wait before using it
+        """
+        if self.rate <= 0:
+            return 0
+
+        now = time()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= 1
+        return max(0, -self.tokens / self.rate)
+
+
+class FifoLimiter:
+    """
+    Limits how many holders run at the same time, admitting waiters in the order they arrived
+    """
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.active = 0
+        # (holder, future)
+        self.waiters = deque()
+
+    def acquire(self, holder):
+        future = Future()
+        if self.limit <= 0 or (self.active < self.limit and not self.waiters):
+            self.active += 1
+            future.set_result(None)
+        else:
+            self.waiters.append((holder, future))
+        return future
+
+    def release(self):
+        # Hand the slot straight to the next waiter
+        while self.waiters:
+            _, future = self.waiters.popleft()
+            if not future.done():
+                future.set_result(None)
+                return
+        self.active -= 1
+
+    def cancel(self, holder):
+        """
+        Remove a holder from the queue
+        Returns False if it was not waiting
+        """
+        for waiter in self.waiters:
+            if waiter[0] is holder:
+                self.waiters.remove(waiter)
+                waiter[1].set_exception(SpawnCancelled())
+                return True
+        return False
+
+    def position(self, holder):
+        """
+        The position of a holder in the queue, starting from 1
+        Returns 0 if it is not waiting
+        """
+        for position, (waiter, _) in enumerate(self.waiters, 1):
+            if waiter is holder:
+                return position
+        return 0
+
+
+class CarinaAdmission(SingletonConfigurable):
+    """
+    Admission control for the spawns, Carina API calls and image pulls of the whole hub
+
+    Under a burst of logins, spawns wait in a queue and Carina API calls and image pulls are
+    rate limited, instead of all tripping upstream rate limits and timing out together.
+    """
+
+    max_concurrent_spawns = Integer(
+        0,
+        help="The maximum number of servers started at the same time. Further spawns wait in a "
+             "queue, which counts towards the spawner's start_timeout. Unlimited when 0.",
+        config=True)
+
+    api_rate = Float(
+        0,
+        help="The maximum average number of Carina API calls per second. Unlimited when 0.",
+        config=True)
+
+    api_burst = Integer(
+        20,
+        help="The number of Carina API calls which may be made at once, above api_rate.",
+        config=True)
+
+    pull_rate = Float(
+        0,
+        help="The maximum average number of image pulls started per second. Unlimited when 0.",
+        config=True)
+
+    pull_burst = Integer(
+        5,
+        help="The number of image pulls which may be started at once, above pull_rate.",
+        config=True)
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.spawns = FifoLimiter(self.max_concurrent_spawns)
+        self.buckets = {
+            'api': TokenBucket(self.api_rate, self.api_burst),
+            'pull': TokenBucket(self.pull_rate, self.pull_burst),
+        }
+
+    def acquire_spawn(self, spawner):
+        """
+        Wait for a spawn slot
+        """
+        future = self.spawns.acquire(spawner)
+        if not future.done():
+            self.log.info("Queued the spawn for %s at position %d", spawner.user.name,
+                          self.spawns.position(spawner))
+        metrics.SPAWN_QUEUE_LENGTH.set(len(self.spawns.waiters))
+        return future
+
+    def release_spawn(self):
+        self.spawns.release()
+        metrics.SPAWN_QUEUE_LENGTH.set(len(self.spawns.waiters))
+
+    def cancel_spawn(self, spawner):
+        if self.spawns.cancel(spawner):
+            self.log.info("Cancelled the queued spawn for %s", spawner.user.name)
+            metrics.SPAWN_QUEUE_LENGTH.set(len(self.spawns.waiters))
+
+    def queue_position(self, spawner):
+        return self.spawns.position(spawner)
+
+    def reserve(self, kind):
+        """
+        Reserve an API call or image pull
+        Returns the number of seconds to wait before making it
+        """
+        delay = self.buckets[kind].reserve()
+        if delay:
+            metrics.ADMISSION_DELAY.labels(kind=kind).observe(delay)
+        return delay
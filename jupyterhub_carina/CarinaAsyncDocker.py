@@ -0,0 +1,196 @@
+import json
+import os.path
+import ssl
+from urllib.parse import quote, urlencode
+from docker.errors import APIError
+from docker.utils import create_container_config, create_host_config, parse_repository_tag
+from tornado import gen
+from tornado.httpclient import HTTPError, HTTPRequest
+from tornado.simple_httpclient import SimpleAsyncHTTPClient
+from .CarinaImagePull import ImagePullError
+
+
+class AsyncDockerResponse:
+    """
+    The parts of a requests.Response that docker-py's APIError relies upon
+    """
+
+    def __init__(self, url, status_code, reason):
+        self.url = url
+        self.status_code = status_code
+        self.reason = reason
+
+
+class AsyncDockerClient:
+    """
+    A Docker client built on Tornado's SimpleAsyncHTTPClient
+
+    Implements the subset of docker-py's Client used by CarinaSpawner and DockerSpawner,
+    returning futures instead of blocking a thread for each call.
+    """
+
+    # The docker-py methods that are implemented
+    methods = {'ping', 'version', 'info', 'inspect_image', 'pull', 'create_container', 'start',
+               'inspect_container', 'port', 'stop', 'remove_container'}
+
+    _http_client = None
+
+    def __init__(self, docker_config, ssl_context=None, max_clients=100):
+        creds_dir = docker_config['DOCKER_CERT_PATH']
+        self.base_url = docker_config['DOCKER_HOST'].replace("tcp://", "https://")
+        self.api_version = None
+
+        self.ssl_context = ssl_context
+        if self.ssl_context is None:
+            # Carina certificates are not issued for the cluster's hostname
+            self.ssl_context = ssl.create_default_context(cafile=os.path.join(creds_dir, 'ca.pem'))
+            self.ssl_context.check_hostname = False
+            self.ssl_context.load_cert_chain(os.path.join(creds_dir, 'cert.pem'),
+                                             os.path.join(creds_dir, 'key.pem'))
+
+        # JupyterHub configures the curl client when pycurl is installed, which doesn't accept
+        # an SSLContext
+        if AsyncDockerClient._http_client is None:
+            AsyncDockerClient._http_client = SimpleAsyncHTTPClient(force_instance=True,
+                                                                   max_clients=max_clients)
+
+    @gen.coroutine
+    def request(self, method, path, params=None, body=None, streaming_callback=None,
+                request_timeout=60, versioned=True, decode=True):
+        """
+        Execute a Docker API request and decode the JSON response
+        """
+        if versioned:
+            yield self.negotiate_version()
+            path = '/v{}{}'.format(self.api_version, path)
+
+        url = self.base_url + path
+        if params:
+            url += '?' + urlencode(params)
+
+        if body is not None:
+            body = json.dumps(body)
+        elif method in ('POST', 'PUT'):
+            body = ''
+
+        request = HTTPRequest(
+            url=url,
+            method=method,
+            body=body,
+            headers={'Content-Type': 'application/json'},
+            ssl_options=self.ssl_context,
+            streaming_callback=streaming_callback,
+            request_timeout=request_timeout)
+
+        try:
+            response = yield self._http_client.fetch(request)
+        except HTTPError as e:
+            if e.response is None:
+                raise
+            explanation = e.response.body.decode('utf8', 'replace') if e.response.body else None
+            raise APIError(str(e), AsyncDockerResponse(url, e.code, e.message), explanation)
+
+        if streaming_callback is not None or not response.body:
+            return None
+        if not decode:
+            return response.body.decode('utf8', 'replace')
+        return json.loads(response.body.decode('utf8', 'replace'))
+
+    @gen.coroutine
+    def negotiate_version(self):
+        """
+        Use the API version of the Docker server
+        """
+        if self.api_version is None:
+            version = yield self.version()
+            self.api_version = version['ApiVersion']
+
+    @staticmethod
+    def _container_id(container):
+        if isinstance(container, dict):
+            container = container['Id']
+        return quote(container, safe='')
+
+    def ping(self):
+        return self.request('GET', '/_ping', versioned=False, decode=False)
+
+    def version(self):
+        return self.request('GET', '/version', versioned=False)
+
+    def info(self):
+        return self.request('GET', '/info')
+
+    def inspect_image(self, image):
+        return self.request('GET', '/images/{}/json'.format(quote(image, safe='/:')))
+
+    def pull(self, repository, tag=None, callback=None, request_timeout=3600):
+        """
+        Pull an image, passing each decoded progress event to the callback
+        """
+        if tag is None:
+            repository, tag = parse_repository_tag(repository)
+        params = {'fromImage': repository}
+        if tag:
+            params['tag'] = tag
+
+        decoder = json.JSONDecoder()
+        buffer = ['']
+
+        def parse_events(chunk):
+            buffer[0] += chunk.decode('utf8', 'replace')
+            while True:
+                data = buffer[0].lstrip()
+                if not data:
+                    buffer[0] = ''
+                    return
+                try:
+                    event, end = decoder.raw_decode(data)
+                except ValueError:
+                    # Wait for the rest of the event
+                    buffer[0] = data
+                    return
+                buffer[0] = data[end:]
+
+                if 'error' in event:
+                    raise ImagePullError(event['error'])
+                if callback is not None:
+                    callback(event)
+
+        return self.request('POST', '/images/create', params=params,
+                            streaming_callback=parse_events, request_timeout=request_timeout)
+
+    @gen.coroutine
+    def create_container(self, image, command=None, name=None, **kwargs):
+        yield self.negotiate_version()
+        params = {'name': name} if name else None
+        config = create_container_config(self.api_version, image, command, **kwargs)
+        return (yield self.request('POST', '/containers/create', params=params, body=config))
+
+    @gen.coroutine
+    def start(self, container, **kwargs):
+        yield self.negotiate_version()
+        body = create_host_config(version=self.api_version, **kwargs) if kwargs else None
+        path = '/containers/{}/start'.format(self._container_id(container))
+        return (yield self.request('POST', path, body=body))
+
+    def inspect_container(self, container):
+        return self.request('GET', '/containers/{}/json'.format(self._container_id(container)))
+
+    @gen.coroutine
+    def port(self, container, private_port):
+        info = yield self.inspect_container(container)
+        ports = info['NetworkSettings'].get('Ports') or {}
+        for protocol in ('tcp', 'udp'):
+            host_ports = ports.get('{}/{}'.format(private_port, protocol))
+            if host_ports:
+                return host_ports
+        return None
+
+    def stop(self, container, timeout=10):
+        return self.request('POST', '/containers/{}/stop'.format(self._container_id(container)),
+                            params={'t': timeout}, request_timeout=timeout + 60)
+
+    def remove_container(self, container, v=False, link=False, force=False):
+        params = {'v': int(v), 'link': int(link), 'force': int(force)}
+        return self.request('DELETE', '/containers/{}'.format(self._container_id(container)),
+                            params=params)
@@ -1,8 +1,13 @@
+from collections import OrderedDict
+from time import time
 from tornado.auth import OAuth2Mixin
 from tornado import gen, web
+from traitlets import Integer
 from traitlets.config import LoggingConfigurable
+from jupyterhub.handlers.login import LogoutHandler
 from oauthenticator import OAuthLoginHandler, OAuthenticator
-from .CarinaOAuthClient import CarinaOAuthClient
+from .CarinaOAuthClient import CarinaOAuthClient, CarinaOAuthCredentials
+from .CarinaTracing import annotate, traced
 
 
 class CarinaLoginHandler(OAuthLoginHandler, OAuth2Mixin):
@@ -16,6 +21,18 @@ class CarinaLoginHandler(OAuthLoginHandler, OAuth2Mixin):
     scope = ['identity', 'read', 'write', 'execute']
 
 
+class CarinaLogoutHandler(LogoutHandler):
+    """
+    Forget the OAuth tokens kept for the user's next server start when they log out
+    """
+
+    def get(self):
+        user = self.current_user
+        if user:
+            self.authenticator.forget_login_credentials(user.name)
+        return super().get()
+
+
 class CarinaAuthenticator(OAuthenticator, LoggingConfigurable):
     """
     Authenticate users with their Carina account
@@ -24,43 +41,142 @@ class CarinaAuthenticator(OAuthenticator, LoggingConfigurable):
     # Configure the base OAuthenticator
     login_service = 'Carina'
     login_handler = CarinaLoginHandler
+    logout_handler = CarinaLogoutHandler
+
+    login_credentials_ttl = Integer(
+        86400,
+        help="The number of seconds that the OAuth tokens of a login are kept for starting the "
+             "user's server, when auth_state is disabled.",
+        config=True)
+
+    max_login_credentials = Integer(
+        1000,
+        help="The maximum number of logins whose OAuth tokens are kept for starting the user's "
+             "server, when auth_state is disabled. The oldest logins are forgotten first.",
+        config=True)
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        # username -> (login time, CarinaOAuthCredentials) from their last login, oldest first,
+        # when auth_state is disabled
+        self.login_credentials = OrderedDict()
+
+    def get_handlers(self, app):
+        handlers = super().get_handlers(app)
+        # Newer versions of OAuthenticator register self.logout_handler themselves
+        if not any(handler[0] == r'/logout' for handler in handlers):
+            handlers.append((r'/logout', self.logout_handler))
+        return handlers
+
+    def create_carina_client(self, user='UNKNOWN'):
+        """
+        Create a Carina client for a single login, so that concurrent logins do not share tokens
+        """
+        return CarinaOAuthClient(self.client_id, self.client_secret, self.oauth_callback_url,
+                                 user=user, parent=self)
 
-    _carina_client = None
     @property
-    def carina_client(self):
-        if self._carina_client is None:
-            self._carina_client = CarinaOAuthClient(self.client_id, self.client_secret, self.oauth_callback_url)
-
-        return self._carina_client
+    def use_auth_state(self):
+        # auth_state is only available with JupyterHub 0.8+, when it is enabled
+        return getattr(self, 'enable_auth_state', False)
 
+    @traced('authenticator.authenticate')
     @gen.coroutine
     def authenticate(self, handler, data=None):
         """
         Complete the OAuth dance and identify the user
+
+        The user's OAuth tokens are saved in their auth_state, when it is enabled, and are
+        otherwise kept until their server is started.
         """
         authorization_code = handler.get_argument("code", False)
         if not authorization_code:
             raise web.HTTPError(400, "OAuth callback made without a token")
 
-        yield self.carina_client.request_tokens(authorization_code)
-        profile = yield self.carina_client.get_user_profile()
+        carina_client = self.create_carina_client()
+        yield carina_client.request_tokens(authorization_code)
+        profile = yield carina_client.get_user_profile()
+
+        # Requesting the profile may have refreshed the tokens, which spends the issued
+        # refresh token
+        credentials = carina_client.credentials
 
         carina_username = profile['username']
-        self.carina_client.user = carina_username
+        carina_client.user = carina_username
+        annotate(user=carina_username)
 
         # verify that the user is authorized on this system
         if self.whitelist and carina_username not in self.whitelist:
-            carina_username = None
-
+            return None
+
+        if self.use_auth_state:
+            return {
+                'name': carina_username,
+                'auth_state': {
+                    'access_token': credentials.access_token,
+                    'refresh_token': credentials.refresh_token,
+                    'expires_at': credentials.expires_at,
+                    'lifetime': credentials.lifetime,
+                },
+            }
+
+        self.remember_login_credentials(carina_username, credentials)
         return carina_username
 
+    def remember_login_credentials(self, username, credentials):
+        """
+        Keep the OAuth tokens of a login until the user's server is started, forgetting expired
+        and, beyond max_login_credentials, the oldest logins
+        """
+        self.login_credentials.pop(username, None)
+        self.login_credentials[username] = (time(), credentials)
+
+        while self.login_credentials:
+            _, (logged_in, _) = next(iter(self.login_credentials.items()))
+            if len(self.login_credentials) <= self.max_login_credentials and \
+                    time() - logged_in < self.login_credentials_ttl:
+                break
+            self.login_credentials.popitem(last=False)
+
+    def forget_login_credentials(self, username):
+        """
+        Forget the OAuth tokens of the user's last login
+        Returns None if they are not kept, or expired
+        """
+        logged_in, credentials = self.login_credentials.pop(username, (0, None))
+        if time() - logged_in >= self.login_credentials_ttl:
+            return None
+        return credentials
+
+    @gen.coroutine
     def pre_spawn_start(self, user, spawner):
         """
-        Update the spawner with the most recent OAuth credentials
+        Update the spawner with the OAuth credentials from the user's most recent login
         """
-        creds = self.carina_client.credentials
+        # The start was requested, don't let the progress page see the previous start's events
+        spawner.request_spawn_progress()
+
+        creds = None
+        if self.use_auth_state:
+            auth_state = yield user.get_auth_state()
+            if auth_state:
+                creds = CarinaOAuthCredentials(auth_state['access_token'],
+                                               auth_state['refresh_token'],
+                                               auth_state['expires_at'],
+                                               auth_state.get('lifetime'))
+        else:
+            creds = self.forget_login_credentials(user.name)
+
         if creds is None:
             return
 
+        # The spawner's tokens may have been refreshed since the login, which spends the old
+        # refresh token
+        current = spawner.carina_client.credentials
+        if current is not None and current.expires_at >= creds.expires_at:
+            self.log.debug("The spawner already has the most recent credentials")
+            return
+
         self.log.debug("Updating the spawner with the most recent credentials")
-        spawner.carina_client.load_credentials(creds.access_token, creds.refresh_token, creds.expires_at)
+        spawner.carina_client.load_credentials(creds.access_token, creds.refresh_token,
+                                               creds.expires_at, creds.lifetime)
@@ -0,0 +1,307 @@
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import json
+import os
+import shutil
+from time import time
+from uuid import uuid4
+from tornado import gen
+from tornado.ioloop import IOLoop, PeriodicCallback
+from traitlets import Integer, Unicode
+from traitlets.config import SingletonConfigurable
+from .CarinaCredentials import create_docker_client, load_docker_config
+from .CarinaImagePull import ImagePullError
+from .CarinaOAuthClient import CarinaOAuthClient
+from .CarinaReadiness import BackoffReadiness
+
+
+class CarinaClusterPool(SingletonConfigurable):
+    """
+    A pool of Carina clusters, created ahead of time on a shared Carina account
+
+    Each cluster in the pool is active, has its credentials downloaded and the
+    container image pulled, so that it can be handed out to a user immediately.
+
+    The credentials of ready clusters, and a marker for each cluster being provisioned, are kept
+    in pool_dir, so that a restarted hub takes the pooled clusters back instead of creating new
+    ones. Clusters which were handed out to users have no entry in pool_dir. The pool account's
+    refresh token is only valid once, so the rotated tokens are saved there too.
+    """
+
+    low_watermark = Integer(
+        1,
+        help="Replenish the pool once fewer than this many clusters are ready or being created.",
+        config=True)
+
+    high_watermark = Integer(
+        0,
+        help="The number of clusters to keep ready when the pool is replenished. "
+             "The pool is disabled when this is 0.",
+        config=True)
+
+    access_token = Unicode(
+        os.environ.get('CARINA_POOL_ACCESS_TOKEN', ''),
+        help="An OAuth access token for the Carina account which owns the pooled clusters.",
+        config=True)
+
+    refresh_token = Unicode(
+        os.environ.get('CARINA_POOL_REFRESH_TOKEN', ''),
+        help="An OAuth refresh token for the Carina account which owns the pooled clusters.",
+        config=True)
+
+    cluster_prefix = Unicode(
+        'jupyterhub-pool',
+        help="The prefix of the name of each pooled cluster.",
+        config=True)
+
+    container_image = Unicode(
+        'jupyter/singleuser',
+        help="The image pulled to each pooled cluster.",
+        config=True)
+
+    pool_dir = Unicode(
+        '/root/.carina/pool',
+        help="The directory where the credentials of pooled clusters are stored.",
+        config=True)
+
+    replenish_interval = Integer(
+        60,
+        help="The number of seconds between checking if the pool needs to be replenished.",
+        config=True)
+
+    max_retry_interval = Integer(
+        3600,
+        help="The maximum number of seconds before replenishing the pool again, after "
+             "provisioning a cluster failed. The interval doubles after each failure.",
+        config=True)
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.ready = deque()
+        self.provisioning = 0
+        self.carina_client = None
+        self.executor = ThreadPoolExecutor(2)
+        self._replenisher = None
+        self._recovered = False
+        self._recovering = False
+        self.failures = 0
+        self._retry_at = 0
+
+    @property
+    def enabled(self):
+        return self.high_watermark > 0 and bool(self.refresh_token)
+
+    def start(self, authenticator):
+        """
+        Start replenishing the pool in the background
+        """
+        if not self.enabled or self._replenisher is not None:
+            return
+
+        self.log.info("Starting the Carina cluster pool (%d-%d clusters)",
+                      self.low_watermark, self.high_watermark)
+        self.carina_client = CarinaOAuthClient(authenticator.client_id,
+                                               authenticator.client_secret,
+                                               authenticator.oauth_callback_url,
+                                               user=self.cluster_prefix,
+                                               on_refresh=self.save_tokens, parent=self)
+        self.load_tokens()
+
+        self._replenisher = PeriodicCallback(self.replenish, self.replenish_interval * 1000)
+        self._replenisher.start()
+        IOLoop.current().add_callback(self.replenish)
+
+    @property
+    def tokens_path(self):
+        return os.path.join(self.pool_dir, 'tokens.json')
+
+    def load_tokens(self):
+        """
+        Load the pool account's OAuth tokens, preferring the tokens saved by a previous run of the
+        hub over the configured ones, whose refresh token that run already spent
+        """
+        self.carina_client.load_credentials(self.access_token, self.refresh_token, 0)
+        try:
+            with open(self.tokens_path) as f:
+                saved = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            self.log.warning("Unable to load the saved Carina cluster pool tokens: %s", e)
+            return
+
+        if saved.get('configured_refresh_token') != self.refresh_token:
+            self.log.info("The Carina cluster pool tokens were reconfigured, ignoring the saved "
+                          "tokens")
+            return
+        self.carina_client.load_credentials(saved['access_token'], saved['refresh_token'],
+                                            saved['expires_at'], saved.get('lifetime'))
+
+    def save_tokens(self, credentials):
+        """
+        Save the pool account's rotated OAuth tokens for the next run of the hub
+        """
+        staging = self.tokens_path + '.tmp'
+        try:
+            os.makedirs(self.pool_dir, exist_ok=True)
+            with open(os.open(staging, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'w') as f:
+                json.dump({
+                    'access_token': credentials.access_token,
+                    'refresh_token': credentials.refresh_token,
+                    'expires_at': credentials.expires_at,
+                    'lifetime': credentials.lifetime,
+                    'configured_refresh_token': self.refresh_token,
+                }, f)
+            os.replace(staging, self.tokens_path)
+        except OSError as e:
+            self.log.error("Unable to save the Carina cluster pool tokens: %s", e)
+
+    @gen.coroutine
+    def recover(self):
+        """
+        Take back the pooled clusters which a previous run of the hub created
+        """
+        self._recovering = True
+        try:
+            clusters = yield self.carina_client.fetch_clusters()
+            os.makedirs(self.pool_dir, exist_ok=True)
+            entries = set(os.listdir(self.pool_dir))
+            for name in entries:
+                cluster_name = name[:-len('.pending')] if name.endswith('.pending') else name
+                if not cluster_name.startswith(self.cluster_prefix + '-'):
+                    continue
+                if cluster_name not in clusters:
+                    self.log.info("Pooled cluster %s no longer exists", cluster_name)
+                    self.discard(cluster_name)
+
+            for name, cluster in clusters.items():
+                if not name.startswith(self.cluster_prefix + '-'):
+                    continue
+                if name in entries or name + '.pending' in entries:
+                    self.log.info("Recovering pooled cluster %s", name)
+                    IOLoop.current().add_future(self.provision(cluster),
+                                                self._log_provision_error)
+            self._recovered = True
+        finally:
+            self._recovering = False
+
+        self.replenish()
+
+    def acquire(self):
+        """
+        Hand out a ready cluster
+        Returns None if the pool is empty
+        """
+        if not self.ready:
+            return None
+
+        cluster = self.ready.popleft()
+        self.log.info("Handing out pooled cluster %s, %d clusters remaining",
+                      cluster['name'], len(self.ready))
+        IOLoop.current().add_callback(self.replenish)
+        return cluster
+
+    def replenish(self):
+        """
+        Create clusters up to the high watermark, once the pool is below its low watermark
+        """
+        if not self._recovered:
+            # Don't create new clusters until the existing ones are known
+            if not self._recovering:
+                IOLoop.current().add_future(self.recover(), self._log_recover_error)
+            return
+        if time() < self._retry_at:
+            return
+
+        available = len(self.ready) + self.provisioning
+        if available >= self.low_watermark or available >= self.high_watermark:
+            return
+
+        self.log.info("Replenishing the Carina cluster pool with %d clusters",
+                      self.high_watermark - available)
+        for _ in range(self.high_watermark - available):
+            IOLoop.current().add_future(self.provision(), self._log_provision_error)
+
+    @gen.coroutine
+    def provision(self, cluster=None):
+        """
+        Create a cluster, download its credentials and pull the container image
+
+        A cluster which is passed in was created by a previous run of the hub, and is provisioned
+        again. A cluster which fails to provision is deleted.
+        """
+        self.provisioning += 1
+        name = cluster['name'] if cluster else '{}-{}'.format(self.cluster_prefix, uuid4().hex[:8])
+        credentials_dir = os.path.join(self.pool_dir, name)
+        pending = self.pending_marker(name)
+        try:
+            if cluster is None:
+                os.makedirs(self.pool_dir, exist_ok=True)
+                open(pending, 'w').close()
+                cluster = yield self.carina_client.create_cluster(name)
+            if not os.path.isdir(credentials_dir):
+                yield self.carina_client.download_cluster_credentials(
+                    cluster['id'], name, self.pool_dir, readiness=BackoffReadiness(parent=self))
+            yield self.executor.submit(self.pull_image, credentials_dir)
+        except Exception:
+            if cluster is not None:
+                try:
+                    yield self.carina_client.delete_cluster(cluster['id'])
+                except Exception as e:
+                    # Keep a marker, so that the next run of the hub takes the cluster back
+                    # instead of leaking it. A recovered cluster may only have had credentials.
+                    self.log.error("Unable to delete pooled cluster %s: %s", name, e)
+                    shutil.rmtree(credentials_dir, ignore_errors=True)
+                    open(pending, 'w').close()
+                    raise
+            self.discard(name)
+            raise
+        finally:
+            self.provisioning -= 1
+
+        if os.path.exists(pending):
+            os.remove(pending)
+        self.ready.append({
+            'id': cluster['id'],
+            'name': name,
+            'credentials_dir': credentials_dir,
+            'container_image': self.container_image,
+        })
+        self.log.info("Pooled cluster %s is ready, %d clusters in the pool",
+                      name, len(self.ready))
+
+    def pending_marker(self, name):
+        """
+        The file which marks that a cluster is being provisioned
+        """
+        return os.path.join(self.pool_dir, name + '.pending')
+
+    def discard(self, name):
+        """
+        Remove a pooled cluster's credentials and marker
+        """
+        shutil.rmtree(os.path.join(self.pool_dir, name), ignore_errors=True)
+        if os.path.exists(self.pending_marker(name)):
+            os.remove(self.pending_marker(name))
+
+    def pull_image(self, credentials_dir):
+        client = create_docker_client(load_docker_config(credentials_dir))
+        for event in client.pull(self.container_image, stream=True, decode=True):
+            if 'error' in event:
+                raise ImagePullError(event['error'])
+
+    def _log_provision_error(self, future):
+        if future.exception() is None:
+            self.failures = 0
+            return
+
+        # Back off, so that a persistent failure doesn't create clusters without end
+        self.failures += 1
+        retry_interval = min(self.replenish_interval * 2 ** self.failures, self.max_retry_interval)
+        self._retry_at = time() + retry_interval
+        self.log.error("Unable to add a cluster to the Carina cluster pool, retrying in %ds: %s",
+                       retry_interval, future.exception())
+
+    def _log_recover_error(self, future):
+        if future.exception() is not None:
+            self.log.error("Unable to recover the Carina cluster pool: %s", future.exception())
@@ -0,0 +1,360 @@
+from concurrent.futures import ThreadPoolExecutor
+import docker
+import hashlib
+import io
+import os
+import re
+import shutil
+import ssl
+import tempfile
+import threading
+from time import time
+from tornado import gen
+from traitlets import Float, Unicode
+from traitlets.config import LoggingConfigurable, SingletonConfigurable
+from zipfile import ZipFile
+
+CREDENTIAL_FILES = ('docker.env', 'ca.pem', 'cert.pem', 'key.pem')
+
+# Reading and writing credentials is kept off the IO loop
+_executor = ThreadPoolExecutor(2)
+
+
+def load_docker_config(creds_dir):
+    """
+    Read the Docker client configuration variables from a cluster's credentials
+    """
+    docker_env = os.path.join(creds_dir, 'docker.env')
+    if not os.path.exists(docker_env):
+        raise RuntimeError(
+            "ERROR! The cluster credentials could not be found in {}.".format(creds_dir))
+
+    with open(docker_env) as f:
+        env = f.read()
+
+    host = re.findall("DOCKER_HOST=(.*)", env)[0]
+    version = re.findall("DOCKER_VERSION=(.*)", env)[0]
+
+    return {
+        'DOCKER_HOST': host,
+        'DOCKER_CERT_PATH': creds_dir,
+        'DOCKER_TLS_VERIFY': 1,
+        'DOCKER_VERSION': version,
+    }
+
+
+def create_docker_client(docker_config):
+    """
+    Create a Docker client connected to a cluster
+    """
+    creds_dir = docker_config['DOCKER_CERT_PATH']
+    api_endpoint = docker_config['DOCKER_HOST'].replace("tcp://", "https://")
+    tls_config = docker.tls.TLSConfig(
+        client_cert=(os.path.join(creds_dir, 'cert.pem'),
+                     os.path.join(creds_dir, 'key.pem')),
+        ca_cert=os.path.join(creds_dir, 'ca.pem'),
+        verify=os.path.join(creds_dir, 'ca.pem'),
+        # docker-py defaults to TLS 1.0, negotiate the newest version instead
+        ssl_version=getattr(ssl, 'PROTOCOL_TLS', ssl.PROTOCOL_SSLv23),
+        assert_hostname=False)
+
+    return docker.Client(version='auto', tls=tls_config, base_url=api_endpoint)
+
+
+def install_credentials(credentials_zip, destination):
+    """
+    Extract a credentials zip into the destination directory
+
+    The zip is extracted to a staging directory first and each top-level entry is then
+    renamed into place, so partially extracted credentials are never visible.
+    Complete credentials which already exist are left alone, incomplete ones are replaced.
+    """
+    os.makedirs(destination, exist_ok=True)
+    staging_dir = tempfile.mkdtemp(prefix='.staging-', dir=destination)
+    try:
+        ZipFile(io.BytesIO(credentials_zip), 'r').extractall(staging_dir)
+        for name in os.listdir(staging_dir):
+            _install_entry(os.path.join(staging_dir, name), os.path.join(destination, name),
+                           staging_dir)
+    finally:
+        shutil.rmtree(staging_dir, ignore_errors=True)
+
+
+def _install_entry(source, target, staging_dir):
+    while True:
+        try:
+            os.rename(source, target)
+            return
+        except OSError:
+            if not os.path.exists(target):
+                raise
+
+        if not os.path.isdir(target) or credentials_complete(target):
+            # The credentials were installed by a concurrent download
+            return
+
+        # Move the incomplete credentials into the staging directory, which is removed afterwards
+        replaced = tempfile.mkdtemp(prefix='.replaced-', dir=staging_dir)
+        try:
+            os.rename(target, os.path.join(replaced, os.path.basename(target)))
+        except FileNotFoundError:
+            # A concurrent download moved them already
+            pass
+
+
+def credentials_complete(creds_dir):
+    """
+    Check if a credentials directory has every file needed to connect to the cluster
+    """
+    return all(os.path.isfile(os.path.join(creds_dir, name)) for name in CREDENTIAL_FILES)
+
+
+def install_credentials_async(credentials_zip, destination):
+    """
+    Extract a credentials zip into the destination directory in a background thread
+    """
+    return _executor.submit(install_credentials, credentials_zip, destination)
+
+
+def zip_credentials(creds_dir):
+    """
+    Create a credentials zip from installed credentials, with the same layout as the zips
+    downloaded from Carina
+    """
+    folder = os.path.basename(os.path.normpath(creds_dir))
+    buffer = io.BytesIO()
+    with ZipFile(buffer, 'w') as credentials:
+        for root, _, files in os.walk(creds_dir):
+            for name in files:
+                path = os.path.join(root, name)
+                credentials.write(path, os.path.join(folder, os.path.relpath(path, creds_dir)))
+    return buffer.getvalue()
+
+
+def zip_credentials_async(creds_dir):
+    """
+    Create a credentials zip from installed credentials in a background thread
+    """
+    return _executor.submit(zip_credentials, creds_dir)
+
+
+class ClusterCredentials:
+    """
+    The parsed credentials of a Carina cluster
+    """
+
+    def __init__(self, creds_dir):
+        self.creds_dir = creds_dir
+        self.docker_config = load_docker_config(creds_dir)
+        self.modified = os.stat(os.path.join(creds_dir, 'docker.env')).st_mtime
+
+        with open(os.path.join(creds_dir, 'cert.pem'), 'rb') as f:
+            self.fingerprint = hashlib.sha256(f.read()).hexdigest()
+        with open(os.path.join(creds_dir, 'ca.pem')) as f:
+            self.ca_cert = f.read()
+
+        self._ssl_context = None
+
+    @property
+    def ssl_context(self):
+        """
+        The TLS context used to connect to the cluster's Docker API
+        """
+        if self._ssl_context is None:
+            context = ssl.create_default_context(cadata=self.ca_cert)
+            # Carina certificates are not issued for the cluster's hostname
+            context.check_hostname = False
+            context.load_cert_chain(os.path.join(self.creds_dir, 'cert.pem'),
+                                    os.path.join(self.creds_dir, 'key.pem'))
+            self._ssl_context = context
+
+        return self._ssl_context
+
+
+class CredentialStore(SingletonConfigurable):
+    """
+    Caches the parsed credentials of each user's cluster in memory
+
+    Cached credentials are checked against the modification time of their docker.env
+    file at most every revalidate_interval seconds.
+    """
+
+    revalidate_interval = Float(
+        30,
+        help="The number of seconds before cached cluster credentials are checked for changes on disk.",
+        config=True)
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        # (user, cluster name) -> (ClusterCredentials or None, last checked)
+        self._credentials = {}
+        self._lock = threading.Lock()
+
+    def cached(self, user, cluster_name):
+        """
+        Get credentials which were checked recently, without touching the disk
+        Returns a (hit, credentials) tuple
+        """
+        entry = self._credentials.get((user, cluster_name))
+        if entry is not None and time() - entry[1] < self.revalidate_interval:
+            return True, entry[0]
+        return False, None
+
+    def get(self, user, cluster_name, creds_dir):
+        """
+        Get the credentials for a cluster, reading them from disk if they changed
+        Returns None if the credentials don't exist
+        """
+        hit, credentials = self.cached(user, cluster_name)
+        if hit:
+            return credentials
+
+        key = (user, cluster_name)
+        with self._lock:
+            entry = self._credentials.get(key)
+            try:
+                modified = os.stat(os.path.join(creds_dir, 'docker.env')).st_mtime
+            except FileNotFoundError:
+                credentials = None
+            else:
+                credentials = entry[0] if entry is not None else None
+                if credentials is None or credentials.modified != modified:
+                    credentials = ClusterCredentials(creds_dir)
+
+            self._credentials[key] = (credentials, time())
+
+        return credentials
+
+    @gen.coroutine
+    def load(self, user, cluster_name, creds_dir):
+        """
+        Get the credentials for a cluster, reading from disk in a background thread
+        """
+        hit, credentials = self.cached(user, cluster_name)
+        if hit:
+            return credentials
+
+        return (yield _executor.submit(self.get, user, cluster_name, creds_dir))
+
+    def invalidate(self, user, cluster_name):
+        """
+        Forget the cached credentials for a cluster, e.g. after they were downloaded or removed
+        """
+        self._credentials.pop((user, cluster_name), None)
+
+
+class CredentialStorage(LoggingConfigurable):
+    """
+    Persists the credentials zip of each user's cluster, so that other hubs can reuse them
+
+    The credentials are always installed on the local disk as well, because the Docker
+    clients load their certificates from files.
+    """
+
+    def load(self, user, cluster_name):
+        """
+        Returns the credentials zip, or None if it isn't stored
+        """
+        return None
+
+    def save(self, user, cluster_name, credentials_zip):
+        pass
+
+    def delete(self, user, cluster_name):
+        pass
+
+    def load_async(self, user, cluster_name):
+        return _executor.submit(self.load, user, cluster_name)
+
+    def save_async(self, user, cluster_name, credentials_zip):
+        return _executor.submit(self.save, user, cluster_name, credentials_zip)
+
+    def delete_async(self, user, cluster_name):
+        return _executor.submit(self.delete, user, cluster_name)
+
+
+class FileCredentialStorage(CredentialStorage):
+    """
+    Only keep the credentials in the local credentials directory
+    """
+    pass
+
+
+class DatabaseCredentialStorage(CredentialStorage):
+    """
+    Store encrypted credentials in a database, such as the JupyterHub database
+
+    Requires the cryptography package.
+    """
+
+    db_url = Unicode(
+        'sqlite:////root/.carina/credentials.sqlite',
+        help="The SQLAlchemy URL of the database where credentials are stored. "
+             "Use JupyterHub's db_url to share the credentials between hubs.",
+        config=True)
+
+    encryption_key = Unicode(
+        os.environ.get('CARINA_CREDENTIALS_KEY', ''),
+        help="The Fernet key used to encrypt the stored credentials. "
+             "Defaults to the CARINA_CREDENTIALS_KEY environment variable.",
+        config=True)
+
+    # SQLAlchemy URL -> (engine, table)
+    _databases = {}
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        try:
+            from cryptography.fernet import Fernet
+        except ImportError:
+            raise RuntimeError("The cryptography package is required to store encrypted "
+                               "Carina credentials in a database")
+
+        if not self.encryption_key:
+            raise RuntimeError("An encryption key is required to store Carina credentials "
+                               "in a database, set CARINA_CREDENTIALS_KEY")
+
+        self.fernet = Fernet(self.encryption_key.encode('ascii'))
+
+    @property
+    def database(self):
+        database = self._databases.get(self.db_url)
+        if database is None:
+            import sqlalchemy as sa
+            engine = sa.create_engine(self.db_url)
+            table = sa.Table(
+                'carina_credentials', sa.MetaData(),
+                sa.Column('user', sa.Unicode(255), primary_key=True),
+                sa.Column('cluster', sa.Unicode(255), primary_key=True),
+                sa.Column('credentials', sa.LargeBinary, nullable=False),
+                sa.Column('updated', sa.Float, nullable=False))
+            table.create(engine, checkfirst=True)
+            database = self._databases[self.db_url] = (engine, table)
+
+        return database
+
+    def load(self, user, cluster_name):
+        engine, table = self.database
+        with engine.connect() as connection:
+            row = connection.execute(
+                table.select().where(table.c.user == user).where(table.c.cluster == cluster_name)
+            ).first()
+
+        if row is None:
+            return None
+        return self.fernet.decrypt(row.credentials)
+
+    def save(self, user, cluster_name, credentials_zip):
+        engine, table = self.database
+        encrypted = self.fernet.encrypt(credentials_zip)
+        with engine.begin() as connection:
+            connection.execute(
+                table.delete().where(table.c.user == user).where(table.c.cluster == cluster_name))
+            connection.execute(table.insert().values(
+                user=user, cluster=cluster_name, credentials=encrypted, updated=time()))
+
+    def delete(self, user, cluster_name):
+        engine, table = self.database
+        with engine.begin() as connection:
+            connection.execute(
+                table.delete().where(table.c.user == user).where(table.c.cluster == cluster_name))
@@ -0,0 +1,82 @@
+from datetime import timezone
+from time import time
+import weakref
+from tornado import gen
+from tornado.ioloop import PeriodicCallback
+from traitlets import Integer
+from traitlets.config import SingletonConfigurable
+
+
+class CarinaCuller(SingletonConfigurable):
+    """
+    Hibernates idle Carina servers
+
+    The container of an idle server is stopped, while the user's cluster, its credentials and
+    the pulled image are kept, so that the next start only has to start the container again.
+    JupyterHub notices that the server stopped the next time it is polled.
+    """
+
+    idle_timeout = Integer(
+        0,
+        help="The number of seconds without activity before a server is hibernated. "
+             "Servers are never hibernated when this is 0.",
+        config=True)
+
+    check_interval = Integer(
+        300,
+        help="The number of seconds between checking for idle servers.",
+        config=True)
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.spawners = weakref.WeakSet()
+        self._checker = None
+
+    @property
+    def enabled(self):
+        return self.idle_timeout > 0
+
+    def register(self, spawner):
+        """
+        Start checking if a spawner's server is idle
+        """
+        self.spawners.add(spawner)
+        if self._checker is None:
+            self.log.info("Hibernating Carina servers which are idle for %d seconds",
+                          self.idle_timeout)
+            self._checker = PeriodicCallback(self.cull, self.check_interval * 1000)
+            self._checker.start()
+
+    def idle_for(self, spawner):
+        """
+        The number of seconds since the server was started or the user was last active
+        """
+        last_active = spawner.last_started
+        last_activity = getattr(spawner.user, 'last_activity', None)
+        if last_activity is not None:
+            # JupyterHub records naive UTC timestamps
+            if last_activity.tzinfo is None:
+                last_activity = last_activity.replace(tzinfo=timezone.utc)
+            last_active = max(last_active, last_activity.timestamp())
+
+        return time() - last_active
+
+    @gen.coroutine
+    def cull(self):
+        idle = [spawner for spawner in list(self.spawners)
+                if spawner.container_id and spawner.last_started
+                and self.idle_for(spawner) >= self.idle_timeout]
+        if not idle:
+            return
+
+        self.log.info("Hibernating %d idle Carina servers", len(idle))
+
+        @gen.coroutine
+        def hibernate(spawner):
+            try:
+                yield spawner.hibernate()
+            except Exception as e:
+                self.log.warning("Unable to hibernate the Carina server for %s: %s",
+                                 spawner.user.name, e)
+
+        yield [hibernate(spawner) for spawner in idle]
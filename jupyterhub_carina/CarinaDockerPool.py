@@ -0,0 +1,126 @@
+from collections import OrderedDict
+import hashlib
+import os.path
+import threading
+from time import time
+from traitlets import Integer
+from traitlets.config import SingletonConfigurable
+from .CarinaCredentials import create_docker_client
+
+
+class DockerClientPool(SingletonConfigurable):
+    """
+    A process-wide pool of Docker clients, keyed by cluster endpoint and client certificate
+
+    Sharing the clients between spawners keeps their TLS connections alive across spawner
+    instances. Clients are used from DockerSpawner's executor threads, so the pool is
+    thread-safe and its methods may block. Spawners get their client from the pool for every
+    call, instead of holding on to it, so clients which are dropped from the pool are closed
+    once their last call completes.
+    """
+
+    max_clients = Integer(
+        256,
+        help="The maximum number of Docker clients to keep. The least recently used client is "
+             "dropped when the pool is full.",
+        config=True)
+
+    health_check_interval = Integer(
+        60,
+        help="The number of seconds before a pooled Docker client is pinged again before it is reused.",
+        config=True)
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        # (DOCKER_HOST, certificate fingerprint) -> [client, last health check]
+        self._clients = OrderedDict()
+        # (DOCKER_HOST, certificate fingerprint) -> lock held while a client is created
+        self._creating = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def client_key(docker_config, fingerprint=None):
+        if fingerprint is None:
+            with open(os.path.join(docker_config['DOCKER_CERT_PATH'], 'cert.pem'), 'rb') as f:
+                fingerprint = hashlib.sha256(f.read()).hexdigest()
+
+        return docker_config['DOCKER_HOST'], fingerprint
+
+    def get(self, docker_config, fingerprint=None):
+        """
+        Get a healthy Docker client for a cluster, creating one if necessary
+
+        Concurrent calls for the same cluster share the client that the first one creates.
+        """
+        key = self.client_key(docker_config, fingerprint)
+        client = self.get_healthy(key)
+        if client is not None:
+            return client
+
+        with self._lock:
+            creating = self._creating.setdefault(key, threading.Lock())
+        try:
+            with creating:
+                client = self.get_healthy(key)
+                if client is None:
+                    client = create_docker_client(docker_config)
+                    with self._lock:
+                        self._clients[key] = [client, time()]
+                        # The dropped clients may still be in use, they are closed once
+                        # they are no longer referenced
+                        while len(self._clients) > self.max_clients:
+                            self._clients.popitem(last=False)
+        finally:
+            with self._lock:
+                if self._creating.get(key) is creating:
+                    del self._creating[key]
+
+        return client
+
+    def get_healthy(self, key):
+        """
+        Get the pooled client for a cluster, pinging it when it wasn't checked recently
+        Returns None if there is no client, or it is unhealthy
+        """
+        with self._lock:
+            entry = self._clients.get(key)
+            if entry is not None:
+                self._clients.move_to_end(key)
+
+        if entry is None:
+            return None
+
+        client, last_checked = entry
+        if time() - last_checked < self.health_check_interval:
+            return client
+
+        try:
+            client.ping()
+            entry[1] = time()
+            return client
+        except Exception as e:
+            self.log.info("Discarding the Docker client for %s: %s", key[0], e)
+            self.evict(client)
+            return None
+
+    def discard(self, docker_config, fingerprint=None):
+        """
+        Remove the client for a cluster whose credentials no longer work, and close it
+        """
+        key = self.client_key(docker_config, fingerprint)
+        with self._lock:
+            entry = self._clients.pop(key, None)
+
+        if entry is not None:
+            entry[0].close()
+
+    def evict(self, client):
+        """
+        Remove a client from the pool and close its connections
+        """
+        with self._lock:
+            for key, entry in list(self._clients.items()):
+                if entry[0] is client:
+                    del self._clients[key]
+
+        client.close()
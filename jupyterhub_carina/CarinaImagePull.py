@@ -0,0 +1,113 @@
+from collections import OrderedDict
+from time import time
+
+
+class ImagePullError(Exception):
+    """
+    Raised when a docker pull fails or stalls
+    """
+    pass
+
+
+class ImagePullProgress:
+    """
+    Tracks the progress of a docker pull from its stream of JSON events
+    """
+
+    def __init__(self, image):
+        self.image = image
+        self.started = time()
+        self.last_event = self.started
+        self.finished = None
+        self._percent = 0
+        # layer id -> {'status', 'current', 'total', 'started', 'finished'}
+        self.layers = OrderedDict()
+
+    def update(self, event):
+        """
+        Apply a progress event from the docker pull stream
+        """
+        now = self.last_event = time()
+
+        layer_id = event.get('id')
+        status = event.get('status', '')
+        if layer_id is None or status.startswith('Pulling from'):
+            return
+
+        layer = self.layers.get(layer_id)
+        if layer is None:
+            layer = self.layers[layer_id] = {
+                'status': status,
+                'current': 0,
+                'total': 0,
+                'started': now,
+                'finished': None,
+            }
+        layer['status'] = status
+
+        # Extraction progress is reported with the same fields, only count downloaded bytes
+        detail = event.get('progressDetail') or {}
+        if status == 'Downloading' and detail.get('total'):
+            layer['current'] = detail.get('current', 0)
+            layer['total'] = detail['total']
+        elif status == 'Download complete':
+            layer['current'] = layer['total']
+        elif status in ('Pull complete', 'Already exists'):
+            layer['current'] = layer['total']
+            layer['finished'] = now
+
+    def finish(self):
+        self.finished = time()
+
+    @property
+    def bytes_downloaded(self):
+        return sum(layer['current'] for layer in self.layers.values())
+
+    @property
+    def bytes_total(self):
+        return sum(layer['total'] for layer in self.layers.values())
+
+    @property
+    def layers_completed(self):
+        return sum(1 for layer in self.layers.values() if layer['finished'] is not None)
+
+    @property
+    def layers_total(self):
+        return len(self.layers)
+
+    @property
+    def percent(self):
+        """
+        The percentage of layers and bytes pulled
+
+        The estimate drops when more layers are found, so the highest estimate so far is used.
+        """
+        if self.finished is not None:
+            return 100
+        if not self.layers:
+            return 0
+
+        # Layer sizes are only known once they start downloading, so weigh both
+        layers = self.layers_completed / self.layers_total
+        downloaded = self.bytes_downloaded / self.bytes_total if self.bytes_total else 0
+        self._percent = max(self._percent, int(100 * (layers + downloaded) / 2))
+        return self._percent
+
+    def stalled_for(self):
+        """
+        The number of seconds since the last progress event
+        """
+        return time() - self.last_event
+
+    def layer_timings(self):
+        """
+        The number of seconds each completed layer took to pull
+        """
+        return OrderedDict((layer_id, layer['finished'] - layer['started'])
+                           for layer_id, layer in self.layers.items()
+                           if layer['finished'] is not None)
+
+    def describe(self):
+        return "{}% ({:.1f}/{:.1f} MB, {}/{} layers)".format(
+            self.percent, self.bytes_downloaded / 1e6, self.bytes_total / 1e6,
+            self.layers_completed, self.layers_total)
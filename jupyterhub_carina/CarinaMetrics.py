@@ -0,0 +1,139 @@
+"""
+Prometheus metrics for spawning servers on Carina
+
+The metrics are registered with the default prometheus_client registry, which JupyterHub
+serves from /hub/metrics. When prometheus_client is not installed they are not recorded.
+"""
+import re
+from urllib.parse import urlsplit
+
+try:
+    from prometheus_client import Counter, Gauge, Histogram
+except ImportError:
+    Counter = Gauge = Histogram = None
+
+
+class NoopMetric:
+    """
+    Stands in for a metric when prometheus_client is not installed
+    """
+
+    def labels(self, *args, **kwargs):
+        return self
+
+    def inc(self, amount=1):
+        pass
+
+    def dec(self, amount=1):
+        pass
+
+    def set(self, value):
+        pass
+
+    def observe(self, value):
+        pass
+
+
+def _metric(metric_class, name, documentation, labelnames=(), **kwargs):
+    if metric_class is None:
+        return NoopMetric()
+    return metric_class(name, documentation, labelnames, **kwargs)
+
+
+# Cluster creation and credential polling take minutes, not seconds
+SPAWN_BUCKETS = (1, 5, 10, 30, 60, 120, 180, 300, 600, 900, 1800, float('inf'))
+
+SPAWN_DURATION = _metric(
+    Histogram, 'carina_spawn_duration_seconds',
+    "Time taken to start a server on Carina",
+    ['status'], buckets=SPAWN_BUCKETS)
+
+SPAWN_STAGE_DURATION = _metric(
+    Histogram, 'carina_spawn_stage_duration_seconds',
+    "Time taken by each stage of starting a server on Carina: cluster, credentials, image and container",
+    ['stage'], buckets=SPAWN_BUCKETS)
+
+SPAWNS_IN_PROGRESS = _metric(
+    Gauge, 'carina_spawns_in_progress',
+    "The number of servers being started on Carina")
+
+CREDENTIALS_WAIT = _metric(
+    Histogram, 'carina_credentials_wait_seconds',
+    "Time spent polling for a new cluster's credentials",
+    buckets=SPAWN_BUCKETS)
+
+CREDENTIALS_ATTEMPTS = _metric(
+    Histogram, 'carina_credentials_attempts',
+    "The number of attempts needed to download a new cluster's credentials",
+    buckets=(1, 2, 3, 5, 8, 13, 21, 34, float('inf')))
+
+IMAGE_PULL_DURATION = _metric(
+    Histogram, 'carina_image_pull_duration_seconds',
+    "Time taken to pull the container image to a cluster",
+    ['status'], buckets=SPAWN_BUCKETS)
+
+IMAGE_PULLS_IN_PROGRESS = _metric(
+    Gauge, 'carina_image_pulls_in_progress',
+    "The number of images being pulled to clusters")
+
+IMAGE_PULL_BYTES = _metric(
+    Counter, 'carina_image_pull_bytes_total',
+    "The number of image bytes downloaded to clusters")
+
+IMAGE_PULL_LAYERS = _metric(
+    Counter, 'carina_image_pull_layers_total',
+    "The number of image layers completed on clusters, pulled or already present",
+    ['status'])
+
+API_REQUEST_DURATION = _metric(
+    Histogram, 'carina_api_request_duration_seconds',
+    "Time taken by requests to the Carina API, including waiting for a connection",
+    ['method', 'endpoint'])
+
+API_ERRORS = _metric(
+    Counter, 'carina_api_errors_total',
+    "The number of failed requests to the Carina API",
+    ['method', 'endpoint', 'code'])
+
+TOKEN_REFRESHES = _metric(
+    Counter, 'carina_token_refreshes_total',
+    "The number of OAuth token refreshes requested from Carina",
+    ['status'])
+
+TOKEN_REJECTIONS = _metric(
+    Counter, 'carina_token_rejections_total',
+    "The number of Carina API requests retried after their OAuth token was rejected")
+
+API_RETRIES = _metric(
+    Counter, 'carina_api_retries_total',
+    "The number of requests to the Carina API which were retried after a transient failure",
+    ['method', 'endpoint', 'code'])
+
+API_FAST_FAILURES = _metric(
+    Counter, 'carina_api_fast_failures_total',
+    "The number of requests to the Carina API which failed fast, because the circuit was open")
+
+API_CIRCUIT_OPEN = _metric(
+    Gauge, 'carina_api_circuit_open',
+    "1 while requests to the Carina API fail fast, otherwise 0")
+
+SPAWN_QUEUE_LENGTH = _metric(
+    Gauge, 'carina_spawn_queue_length',
+    "The number of spawns waiting for CarinaAdmission.max_concurrent_spawns")
+
+ADMISSION_DELAY = _metric(
+    Histogram, 'carina_admission_delay_seconds',
+    "Time that Carina API calls and image pulls were delayed by their rate limit",
+    ['kind'])
+
+
+# Cluster ids, and anything else which looks like an id, would give each cluster its own series
+_ID_SEGMENT = re.compile(r'^(?:[0-9]+|[0-9a-fA-F-]{16,})$')
+
+
+def api_endpoint(url):
+    """
+    The path of a Carina API url, with ids replaced so that it can be used as a label
+    """
+    segments = urlsplit(url).path.split('/')
+    return '/'.join(':id' if _ID_SEGMENT.match(segment) else segment for segment in segments)
@@ -1,28 +1,62 @@
 import json
 import os
 from time import time, ctime
+import weakref
 from tornado import gen
-from tornado.httpclient import HTTPRequest, HTTPError, AsyncHTTPClient
+from tornado.ioloop import IOLoop, PeriodicCallback
+from tornado.httpclient import HTTPRequest, HTTPError
+from tornado.simple_httpclient import SimpleAsyncHTTPClient
+from traitlets import Enum, Float, Integer
 from traitlets.config import LoggingConfigurable
 import urllib
-from zipfile import ZipFile
+from .CarinaAdmission import CarinaAdmission
+from .CarinaCredentials import install_credentials_async
+from . import CarinaMetrics as metrics
+from .CarinaReadiness import FixedIntervalReadiness
+from .CarinaRetry import CircuitBreaker, RetryPolicy, error_code
+from .CarinaTracing import annotate, traced
 from ._version import __version__
 
+def _client_attributes(client, *args, **kwargs):
+    return {'user': client.user}
+
+
+def _request_attributes(client, request, *args, **kwargs):
+    return {'user': client.user, 'http.method': request.method, 'http.url': request.url}
+
+
 class CarinaOAuthCredentials:
     """
     A set of Carina OAuth credentials
     """
 
-    def __init__(self, access_token, refresh_token, expires_at):
+    def __init__(self, access_token, refresh_token, expires_at, lifetime=None):
         self.access_token = access_token
         self.refresh_token = refresh_token
         self.expires_at = expires_at
+        # The number of seconds that the access_token was issued for, if known
+        self.lifetime = lifetime
 
     def is_expired(self):
         """
         Check if the access_token is, or is about to be, expired
         """
-        return time() >= (self.expires_at + 60)
+        return self.expires_within(60)
+
+    def expires_within(self, seconds):
+        """
+        Check if the access_token expires within the specified number of seconds
+        """
+        return time() >= (self.expires_at - seconds)
+
+    def refresh_margin(self, margin):
+        """
+        Cap a refresh margin at half of the access_token's lifetime, so that short-lived tokens
+        are not refreshed before every request
+        """
+        if self.lifetime:
+            return min(margin, self.lifetime / 2)
+        return margin
 
 
 class CarinaOAuthClient(LoggingConfigurable):
@@ -31,23 +65,145 @@ class CarinaOAuthClient(LoggingConfigurable):
     """
 
     CARINA_OAUTH_HOST = os.environ.get('CARINA_OAUTH_HOST') or 'oauth.getcarina.com'
-    CARINA_AUTHORIZE_URL = "https://%s/oauth/authorize" % CARINA_OAUTH_HOST
-    CARINA_TOKEN_URL = "https://%s/oauth/token" % CARINA_OAUTH_HOST
-    CARINA_PROFILE_URL = "https://%s/users/current" % CARINA_OAUTH_HOST
-    CARINA_CLUSTERS_URL = "https://%s/proxy/clusters" % CARINA_OAUTH_HOST
-    CARINA_TEMPLATES_URL = "https://%s/proxy/cluster_types" % CARINA_OAUTH_HOST
-
-    def __init__(self, client_id, client_secret, callback_url, user='UNKNOWN'):
-        super().__init__()
+    # Overrides the scheme and host, e.g. to use the fake Carina API in benchmarks/
+    CARINA_OAUTH_URL = os.environ.get('CARINA_OAUTH_URL') or "https://%s" % CARINA_OAUTH_HOST
+    CARINA_AUTHORIZE_URL = "%s/oauth/authorize" % CARINA_OAUTH_URL
+    CARINA_TOKEN_URL = "%s/oauth/token" % CARINA_OAUTH_URL
+    CARINA_PROFILE_URL = "%s/users/current" % CARINA_OAUTH_URL
+    CARINA_CLUSTERS_URL = "%s/proxy/clusters" % CARINA_OAUTH_URL
+    CARINA_TEMPLATES_URL = "%s/proxy/cluster_types" % CARINA_OAUTH_URL
+
+    http_backend = Enum(
+        ['curl', 'simple'],
+        'curl',
+        help="The Tornado HTTP client used to call the Carina API. The curl client keeps "
+             "connections alive and requires pycurl, otherwise the simple client is used.",
+        config=True)
+
+    max_clients = Integer(
+        50,
+        help="The maximum number of concurrent requests to the Carina API.",
+        config=True)
+
+    connect_timeout = Float(
+        10,
+        help="The number of seconds to wait for a connection to the Carina API.",
+        config=True)
+
+    request_timeout = Float(
+        60,
+        help="The number of seconds to wait for a response from the Carina API.",
+        config=True)
+
+    # The HTTP client is shared by the authenticator and every spawner
+    _http_client = None
+
+    cluster_cache_ttl = Integer(
+        30,
+        help="The number of seconds that a user's cluster listing is reused before it is "
+             "requested again from Carina.",
+        config=True)
+
+    # Cluster listings are shared by every client acting on behalf of the same user
+    # user -> (timestamp, {cluster name: cluster})
+    _cluster_cache = {}
+    # user -> in-flight cluster listing request
+    _cluster_requests = {}
+    # user -> the number of times the listing was invalidated, so that a listing which was
+    # requested before an invalidation is not cached
+    _cluster_generations = {}
+    cluster_cache_stats = {'hits': 0, 'misses': 0, 'shared': 0}
+
+    swarm_template_ttl = Integer(
+        3600,
+        help="The number of seconds between refreshing the cached Docker Swarm template in the "
+             "background. The cached template is used while it is refreshed.",
+        config=True)
+
+    # The swarm template is the same for every user
+    # (timestamp, template id)
+    _swarm_template = None
+    _swarm_template_request = None
+    # The most recent client to look up the template, whose tokens the periodic refresh uses
+    _swarm_template_client = None
+    _swarm_template_refresher = None
+
+    token_refresh_margin = Integer(
+        300,
+        help="The number of seconds before an OAuth access token expires that it is refreshed "
+             "in the background, at most half of the token's lifetime.",
+        config=True)
+
+    # Refreshes are shared by every client holding the same refresh token. Completed
+    # refreshes are kept until the new tokens expire, so that clients with an older copy of
+    # the credentials pick up the rotated tokens instead of reusing a spent refresh token.
+    # refresh token -> future resolving to the new CarinaOAuthCredentials
+    _token_refreshes = {}
+
+    def __init__(self, client_id, client_secret, callback_url, user='UNKNOWN', on_refresh=None,
+                 **kwargs):
+        super().__init__(**kwargs)
         self.client_id = client_id
         self.client_secret = client_secret
         self.callback_url = callback_url
         self.credentials = None
         self.user = user
+        # Called with the new credentials after the tokens were refreshed
+        self.on_refresh = on_refresh
+        self._retry_policy = None
+
+    @property
+    def http_client(self):
+        if CarinaOAuthClient._http_client is None:
+            CarinaOAuthClient._http_client = self.create_http_client()
 
-    def load_credentials(self, access_token, refresh_token, expires_at):
-        self.credentials = CarinaOAuthCredentials(access_token, refresh_token, expires_at)
+        return CarinaOAuthClient._http_client
 
+    def create_http_client(self):
+        """
+        Create the HTTP client used to call the Carina API
+        """
+        kwargs = {
+            'force_instance': True,
+            'max_clients': self.max_clients,
+            'defaults': {
+                'connect_timeout': self.connect_timeout,
+                'request_timeout': self.request_timeout,
+            },
+        }
+
+        if self.http_backend == 'curl':
+            try:
+                from tornado.curl_httpclient import CurlAsyncHTTPClient
+                return CurlAsyncHTTPClient(**kwargs)
+            except ImportError:
+                self.log.warning("pycurl is not installed, using the simple HTTP client "
+                                 "for the Carina API")
+
+        return SimpleAsyncHTTPClient(**kwargs)
+
+    @property
+    def retry_policy(self):
+        """
+        Decides which failed requests are retried
+        """
+        if self._retry_policy is None:
+            self._retry_policy = RetryPolicy(parent=self)
+
+        return self._retry_policy
+
+    @property
+    def circuit_breaker(self):
+        """
+        Fails requests fast while the Carina API is failing, shared by all clients
+        """
+        return CircuitBreaker.instance(config=self.config)
+
+    def load_credentials(self, access_token, refresh_token, expires_at, lifetime=None):
+        self.credentials = CarinaOAuthCredentials(access_token, refresh_token, expires_at,
+                                                  lifetime)
+
+    @traced('carina.request_tokens', _client_attributes)
     @gen.coroutine
     def request_tokens(self, authorization_code):
         """
@@ -61,23 +217,65 @@ class CarinaOAuthClient(LoggingConfigurable):
             'grant_type': 'authorization_code'
         }
 
-        yield self.execute_token_request(body)
+        return (yield self.execute_token_request(body))
 
+    @traced('carina.refresh_tokens', _client_attributes)
     @gen.coroutine
     def refresh_tokens(self):
         """
         Exchange a refresh token for a new set of tokens
 
+        Concurrent refreshes of the same credentials share a single token request.
+
         See: https://github.com/doorkeeper-gem/doorkeeper/wiki/API-endpoint-descriptions-and-examples#curl-command-refresh-token-grant
         """
-        self.log.info("Refreshing oauth tokens for %s", self.user)
-        body = {
-            'refresh_token': self.credentials.refresh_token,
-            'grant_type': 'refresh_token'
-        }
+        refresh_token = self.credentials.refresh_token
+        pending = self._token_refreshes.get(refresh_token)
+        if pending is None:
+            self.log.info("Refreshing oauth tokens for %s", self.user)
+            self.prune_token_refreshes()
+            body = {
+                'refresh_token': refresh_token,
+                'grant_type': 'refresh_token'
+            }
+            pending = self._token_refreshes[refresh_token] = self.execute_token_request(body)
+
+            def forget_failure(future):
+                if future.exception() is not None:
+                    self._token_refreshes.pop(refresh_token, None)
+                    metrics.TOKEN_REFRESHES.labels(status='failure').inc()
+                else:
+                    metrics.TOKEN_REFRESHES.labels(status='success').inc()
+            pending.add_done_callback(forget_failure)
+        else:
+            self.log.debug("Using the shared oauth token refresh for %s", self.user)
+
+        self.credentials = yield pending
+        if self.on_refresh is not None:
+            self.on_refresh(self.credentials)
+        return self.credentials
+
+    def refresh_tokens_in_background(self):
+        """
+        Refresh the OAuth tokens without waiting for the new tokens
+        """
+        def log_error(future):
+            if future.exception() is not None:
+                self.log.warning("Unable to refresh the oauth tokens for %s: %s",
+                                 self.user, future.exception())
 
-        yield self.execute_token_request(body)
+        IOLoop.current().add_future(self.refresh_tokens(), log_error)
+
+    @classmethod
+    def prune_token_refreshes(cls):
+        """
+        Forget completed token refreshes whose tokens have since expired
+        """
+        for refresh_token, future in list(cls._token_refreshes.items()):
+            if future.done() and (future.exception() is not None or future.result().is_expired()):
+                cls._token_refreshes.pop(refresh_token, None)
 
+    @traced('carina.get_user_profile', _client_attributes)
     @gen.coroutine
     def get_user_profile(self):
         """
@@ -94,6 +292,7 @@ class CarinaOAuthClient(LoggingConfigurable):
         result = json.loads(response.body.decode('utf8', 'replace'))
         return result
 
+    @traced('carina.create_cluster', _client_attributes)
     @gen.coroutine
     def create_cluster(self, cluster_name):
         """
@@ -117,16 +316,150 @@ class CarinaOAuthClient(LoggingConfigurable):
             })
         self.log.info("Request: %s", request.body)
 
-        response = yield self.execute_oauth_request(request)
+        # Creating a cluster isn't idempotent, so it is only retried after checking that the
+        # failed request did not create the cluster anyway
+        intervals = self.retry_policy.intervals()
+        attempt = 0
+        while True:
+            attempt += 1
+            try:
+                response = yield self.execute_oauth_request(request)
+                break
+            except Exception as e:
+                code = error_code(e)
+                if not self.retry_policy.is_transient(code) and code != 409:
+                    raise
+
+                self.invalidate_clusters()
+                cluster = (yield self.fetch_clusters()).get(cluster_name)
+                if cluster is not None:
+                    self.log.info("Cluster %s/%s was created, although the request failed (%s)",
+                                  self.user, cluster_name, code)
+                    return cluster
+                if code == 409 or attempt >= self.retry_policy.max_attempts:
+                    raise
+
+                interval = self.retry_policy.retry_after(getattr(e, 'response', None),
+                                                         next(intervals))
+                self.log.warning("Creating cluster %s/%s failed (%s), retrying in %.1f seconds",
+                                 self.user, cluster_name, code, interval)
+                yield gen.sleep(interval)
+            finally:
+                self.invalidate_clusters()
+
         result = json.loads(response.body.decode('utf8', 'replace'))
         self.log.info("Response: %s", response.body)
 
         return result
 
+    @traced('carina.delete_cluster', _client_attributes)
+    @gen.coroutine
+    def delete_cluster(self, cluster_id):
+        """
+        Delete a Carina cluster
+        """
+        self.log.info("Deleting cluster %s/%s", self.user, cluster_id)
+        request = HTTPRequest(
+            url=os.path.join(self.CARINA_CLUSTERS_URL, cluster_id),
+            method='DELETE',
+            headers={
+                'Accept': 'application/json'
+            })
+
+        try:
+            yield self.execute_oauth_request(request)
+        finally:
+            self.invalidate_clusters()
+
+    @traced('carina.lookup_swarm_template', _client_attributes)
     @gen.coroutine
     def lookup_swarm_template(self):
         """
         Lookup the latest template for Docker Swarm
+
+        The template is shared by all users, and is refreshed in the background every
+        swarm_template_ttl seconds. A stale template is used while it is refreshed, only the
+        first lookup waits for the template.
+        """
+        self.keep_swarm_template_warm()
+        cached = CarinaOAuthClient._swarm_template
+        if cached is None:
+            return (yield self.fetch_swarm_template())
+
+        if time() - cached[0] >= self.swarm_template_ttl:
+            self.warm_swarm_template()
+
+        return cached[1]
+
+    def keep_swarm_template_warm(self):
+        """
+        Refresh the swarm template periodically, with the tokens of the most recent client to
+        look it up
+        """
+        CarinaOAuthClient._swarm_template_client = weakref.ref(self)
+        if CarinaOAuthClient._swarm_template_refresher is not None:
+            return
+
+        def refresh():
+            client = CarinaOAuthClient._swarm_template_client()
+            if client is not None and client.credentials is not None:
+                client.warm_swarm_template(force=True)
+
+        refresher = PeriodicCallback(refresh, self.swarm_template_ttl * 1000)
+        refresher.start()
+        CarinaOAuthClient._swarm_template_refresher = refresher
+
+    def warm_swarm_template(self, force=False):
+        """
+        Refresh the cached swarm template in the background, if it is missing or stale
+        """
+        self.keep_swarm_template_warm()
+        cached = CarinaOAuthClient._swarm_template
+        if not force and cached is not None and time() - cached[0] < self.swarm_template_ttl:
+            return
+
+        def log_error(future):
+            if future.exception() is not None:
+                self.log.warning("Unable to refresh the Carina swarm template: %s",
+                                 future.exception())
+
+        IOLoop.current().add_future(self.fetch_swarm_template(), log_error)
+
+    def fetch_swarm_template(self):
+        """
+        Request the latest swarm template, sharing any request that is already in-flight
+        """
+        pending = CarinaOAuthClient._swarm_template_request
+        if pending is not None:
+            return self.join_swarm_template_request(pending)
+
+        pending = CarinaOAuthClient._swarm_template_request = self.request_swarm_template()
+
+        def clear_request(future):
+            CarinaOAuthClient._swarm_template_request = None
+        pending.add_done_callback(clear_request)
+
+        return pending
+
+    @gen.coroutine
+    def join_swarm_template_request(self, pending):
+        """
+        Wait for the swarm template request of another client
+
+        The request was made with the other user's tokens. If it failed, e.g. because Carina
+        rejected them, the template is requested again with this client's tokens.
+        """
+        try:
+            return (yield pending)
+        except Exception as e:
+            self.log.info("The shared lookup of the Carina swarm template failed, looking it up "
+                          "for %s: %s", self.user, e)
+            return (yield self.request_swarm_template())
+
+    @gen.coroutine
+    def request_swarm_template(self):
+        """
+        Download the cluster templates and find the most recent one for Docker Swarm
         """
         self.log.info("Looking up latest Carina swarm template")
         request = HTTPRequest(
@@ -148,6 +481,7 @@ class CarinaOAuthClient(LoggingConfigurable):
         if template_id == 0:
             raise Exception('Unable to find a Docker Swarm template')
 
+        CarinaOAuthClient._swarm_template = (time(), template_id)
         return template_id
 
     @gen.coroutine
@@ -157,6 +491,48 @@ class CarinaOAuthClient(LoggingConfigurable):
         Returns None if it doesn't exist
         """
         self.log.info("Retrieving cluster %s/%s ", self.user, cluster_name)
+        clusters = yield self.list_clusters()
+        return clusters.get(cluster_name)
+
+    @traced('carina.list_clusters', _client_attributes)
+    @gen.coroutine
+    def list_clusters(self):
+        """
+        Retrieve the user's Carina clusters, indexed by name
+
+        The listing is cached for cluster_cache_ttl seconds and concurrent lookups
+        for the same user share a single request.
+        """
+        cached = self._cluster_cache.get(self.user)
+        if cached is not None and time() - cached[0] < self.cluster_cache_ttl:
+            self.cluster_cache_stats['hits'] += 1
+            return cached[1]
+
+        pending = self._cluster_requests.get(self.user)
+        if pending is not None:
+            self.cluster_cache_stats['shared'] += 1
+        else:
+            self.cluster_cache_stats['misses'] += 1
+            user = self.user
+            pending = self._cluster_requests[user] = self.fetch_clusters()
+
+            def clear_request(future):
+                if self._cluster_requests.get(user) is future:
+                    del self._cluster_requests[user]
+            pending.add_done_callback(clear_request)
+
+        return (yield pending)
+
+    @gen.coroutine
+    def fetch_clusters(self):
+        """
+        Download the user's cluster listing and refresh the cache
+
+        The listing is not cached when the cache was invalidated while it was requested, because
+        it may not include a cluster which was created in the meantime.
+        """
+        self.log.debug("Listing clusters for %s", self.user)
+        generation = self._cluster_generations.get(self.user, 0)
         request = HTTPRequest(
             url=self.CARINA_CLUSTERS_URL,
             method='GET',
@@ -168,21 +544,36 @@ class CarinaOAuthClient(LoggingConfigurable):
         response = yield self.execute_oauth_request(request)
         result = json.loads(response.body.decode('utf8', 'replace'))
 
-        for cluster in result['clusters']:
-            if cluster['name'] == cluster_name:
-                return cluster
+        clusters = {cluster['name']: cluster for cluster in result['clusters']}
+        if self._cluster_generations.get(self.user, 0) == generation:
+            self._cluster_cache[self.user] = (time(), clusters)
+        return clusters
 
-        return None
+    def invalidate_clusters(self):
+        """
+        Discard the user's cached cluster listing, and any listing which is still being requested
+        """
+        self._cluster_generations[self.user] = self._cluster_generations.get(self.user, 0) + 1
+        self._cluster_cache.pop(self.user, None)
+        self._cluster_requests.pop(self.user, None)
 
+    @traced('carina.download_cluster_credentials', _client_attributes)
     @gen.coroutine
     def download_cluster_credentials(self, cluster_id, cluster_name, destination,
-                                     polling_interval=30):
+                                     polling_interval=30, readiness=None, on_attempt=None):
         """
         Download a cluster's credentials to the specified location
 
         The API will return 404 if the cluster isn't available yet,
-        in which case the request should be retried.
+        in which case the request is retried according to the readiness strategy.
+        on_attempt is called with the number of attempts and the seconds spent waiting, after
+        each attempt which found that the cluster is not yet active.
+        Returns the number of attempts, the seconds spent waiting for the cluster and the
+        credentials zip.
         """
+        if readiness is None:
+            readiness = FixedIntervalReadiness(interval=polling_interval, parent=self)
+
         self.log.info("Downloading cluster credentials for %s/%s (%s)",
                       self.user, cluster_name, cluster_id)
         request = HTTPRequest(
@@ -193,19 +584,32 @@ class CarinaOAuthClient(LoggingConfigurable):
             })
 
         # Poll for the cluster credentials until the cluster is active
+        started = time()
+        intervals = readiness.intervals()
+        attempt = 0
         while True:
-            response = yield self.execute_oauth_request(request, raise_error=False)
+            attempt += 1
+            attempt_started = time()
+            response = None
+            if (yield readiness.is_ready(self, cluster_name)):
+                response = yield self.execute_oauth_request(request, raise_error=False)
 
-            if response.error is None:
+            self.log.debug("Attempt %d to download the credentials for %s/%s (%s) took %.2fs",
+                           attempt, self.user, cluster_name, cluster_id, time() - attempt_started)
+
+            if response is not None and response.error is None:
                 self.log.debug("Credentials for %s/%s (%s) received.",
                                self.user, cluster_name, cluster_id)
                 break
 
-            if response.code == 404 and "Cluster credentials do not exist" in response.body.decode(
-                    encoding='UTF-8'):
-                self.log.debug("The %s/%s (%s) cluster is not yet active, retrying in %s "
-                               "seconds...", self.user, cluster_name, cluster_id, polling_interval)
-                yield gen.sleep(polling_interval)
+            if response is None or (response.code == 404 and "Cluster credentials do not exist" in
+                                    response.body.decode(encoding='UTF-8')):
+                if on_attempt is not None:
+                    on_attempt(attempt, time() - started)
+                interval = next(intervals)
+                self.log.debug("The %s/%s (%s) cluster is not yet active, retrying in %.1f "
+                               "seconds...", self.user, cluster_name, cluster_id, interval)
+                yield gen.sleep(interval)
                 continue
 
             # abort, something bad happened!
@@ -216,10 +620,20 @@ class CarinaOAuthClient(LoggingConfigurable):
                 response.code, response.body, response.error)
             raise response.error
 
-        credentials_zip = ZipFile(response.buffer, "r")
-        credentials_zip.extractall(destination)
+        wait = time() - started
+        self.log.info("The %s/%s (%s) cluster was ready after %d attempts and %.1f seconds",
+                      self.user, cluster_name, cluster_id, attempt, wait)
+        metrics.CREDENTIALS_WAIT.observe(wait)
+        metrics.CREDENTIALS_ATTEMPTS.observe(attempt)
+
+        yield install_credentials_async(response.body, destination)
         self.log.info("Credentials downloaded to %s", destination)
 
+        # The cluster is active now, so the cached listing is stale
+        self.invalidate_clusters()
+
+        return {'attempts': attempt, 'wait': wait, 'credentials_zip': response.body}
+
     @gen.coroutine
     def execute_token_request(self, body):
         """
@@ -248,31 +662,40 @@ class CarinaOAuthClient(LoggingConfigurable):
         self.credentials = CarinaOAuthCredentials(
             access_token=result['access_token'],
             refresh_token=result['refresh_token'],
-            expires_at=request_timestamp + int(result['expires_in']))
+            expires_at=request_timestamp + int(result['expires_in']),
+            lifetime=int(result['expires_in']))
+        return self.credentials
 
     @gen.coroutine
     def execute_oauth_request(self, request, raise_error=True):
         """
         Execute an OAuth request
 
-        Retry with a new set of tokens when the OAuth access token is expired or rejected
+        Retry with a new set of tokens when the OAuth access token is expired or rejected.
+        Tokens which are about to expire are refreshed in the background.
         """
         if self.credentials.is_expired():
             self.log.info("The OAuth token for %s expired at %s", self.user,
                           ctime(self.credentials.expires_at))
             yield self.refresh_tokens()
+        elif self.credentials.expires_within(
+                self.credentials.refresh_margin(self.token_refresh_margin)):
+            self.refresh_tokens_in_background()
 
+        credentials = self.credentials
         self.authorize_request(request)
 
         try:
             return (yield self.execute_request(request, raise_error))
         except HTTPError as e:
-            if e.response.code != 401:
+            if e.code != 401:
                 raise
 
-            # Try once more with a new set of tokens
+            # Try once more with a new set of tokens, unless they were refreshed in the meantime
             self.log.info("The OAuth token for %s was rejected", self.user)
-            yield self.refresh_tokens()
+            metrics.TOKEN_REJECTIONS.inc()
+            if self.credentials is credentials:
+                yield self.refresh_tokens()
             self.authorize_request(request)
             return (yield self.execute_request(request, raise_error))
 
@@ -287,17 +710,90 @@ class CarinaOAuthClient(LoggingConfigurable):
     @gen.coroutine
     def execute_request(self, request, raise_error=True):
         """
-        Execute an HTTP request and log the error, if any
+        Execute an HTTP request, retrying transient failures according to the retry policy
+
+        Fails fast with CircuitOpenError while the Carina API is failing.
+        """
+        intervals = self.retry_policy.intervals()
+        attempt = 0
+        while True:
+            attempt += 1
+            self.circuit_breaker.check()
+            error = None
+            try:
+                response = yield self.send_request(request, raise_error)
+                code = response.code if response.error is not None else None
+            except Exception as e:
+                error = e
+                code = error_code(e)
+                response = getattr(e, 'response', None)
+
+            if self.retry_policy.is_transient(code):
+                self.circuit_breaker.record_failure()
+            else:
+                self.circuit_breaker.record_success()
+
+            if not self.retry_policy.should_retry(request, code, attempt):
+                if error is not None:
+                    raise error
+                return response
+
+            interval = self.retry_policy.retry_after(response, next(intervals))
+            self.log.warning("%s %s failed (%s), retrying in %.1f seconds (attempt %d of %d)",
+                             request.method, request.url, code, interval, attempt + 1,
+                             self.retry_policy.max_attempts)
+            metrics.API_RETRIES.labels(method=request.method,
+                                       endpoint=metrics.api_endpoint(request.url), code=code).inc()
+            yield gen.sleep(interval)
+
+    @traced('carina.http', _request_attributes)
+    @gen.coroutine
+    def send_request(self, request, raise_error=True):
+        """
+        Execute a single HTTP request and log the error, if any
         """
 
         self.log.debug("%s %s", request.method, request.url)
-        http_client = AsyncHTTPClient()
         request.headers.update({
             'User-Agent': 'jupyterhub-carina/' + __version__
         })
+        delay = CarinaAdmission.instance(config=self.config).reserve('api')
+        if delay:
+            annotate(**{'admission.delay': delay})
+            yield gen.sleep(delay)
+
+        started = time()
         try:
-            return (yield http_client.fetch(request, raise_error=raise_error))
+            response = yield self.http_client.fetch(request, raise_error=raise_error)
         except HTTPError as e:
+            self.log_timing(request, e.response, started)
+            self.record_error(request, e.code)
+            annotate(**{'http.status_code': e.code})
             self.log.exception('An error occurred executing %s %s:\n(%s) %s',
-                               request.method, request.url, e.response.code, e.response.body)
+                               request.method, request.url, e.code,
+                               e.response.body if e.response else None)
             raise
+
+        self.log_timing(request, response, started)
+        annotate(**{'http.status_code': response.code})
+        if response.error is not None:
+            self.record_error(request, response.code)
+        return response
+
+    def record_error(self, request, code):
+        """
+        Count a failed request in the Carina API metrics
+        """
+        metrics.API_ERRORS.labels(method=request.method, endpoint=metrics.api_endpoint(request.url),
+                                  code=code).inc()
+
+    def log_timing(self, request, response, started):
+        """
+        Log how long a request spent waiting for a connection and on the network
+        """
+        total = time() - started
+        metrics.API_REQUEST_DURATION.labels(method=request.method,
+                                            endpoint=metrics.api_endpoint(request.url)).observe(total)
+        network = response.request_time if response is not None else total
+        self.log.debug("%s %s took %.3fs (%.3fs queued)", request.method, request.url, total,
+                       max(total - network, 0))
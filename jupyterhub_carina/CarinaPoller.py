@@ -0,0 +1,148 @@
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from time import time
+import weakref
+from tornado import gen
+from tornado.locks import Semaphore
+from traitlets import Float, Integer
+from traitlets.config import SingletonConfigurable
+
+
+class CarinaPoller(SingletonConfigurable):
+    """
+    Polls every running Carina server in a single sweep, with bounded parallelism
+
+    JupyterHub polls each spawner separately. When batch polling is enabled, the first poll
+    after the results expire checks every registered server and the other polls reuse the results.
+    Without async_docker, the checks run on the poller's own threads, instead of DockerSpawner's
+    single thread.
+    """
+
+    concurrency = Integer(
+        20,
+        help="The maximum number of servers checked at the same time during a sweep, "
+             "and the number of threads which check them without async_docker.",
+        config=True)
+
+    timeout = Float(
+        10,
+        help="The number of seconds before checking a server is abandoned. "
+             "A server which could not be checked in time is assumed to still be running.",
+        config=True)
+
+    max_age = Float(
+        30,
+        help="The number of seconds that the results of a sweep are reused. JupyterHub staggers "
+             "the polls of its servers, so this should be at least the spawners' poll_interval, "
+             "which defaults to 30 seconds.",
+        config=True)
+
+    report_slowest = Integer(
+        5,
+        help="The number of slowest servers logged after each sweep.",
+        config=True)
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.spawners = weakref.WeakSet()
+        # spawner -> (timestamp, status, exception)
+        self.results = weakref.WeakKeyDictionary()
+        self.last_sweep = None
+        self._sweep = None
+        # spawner -> check which is still running after it timed out
+        self.pending = weakref.WeakKeyDictionary()
+        self._executor = None
+
+    @property
+    def executor(self):
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(self.concurrency)
+
+        return self._executor
+
+    def register(self, spawner):
+        self.spawners.add(spawner)
+
+    def forget(self, spawner):
+        """
+        Discard the last result for a spawner, e.g. after it was started or stopped
+        """
+        self.results.pop(spawner, None)
+
+    @gen.coroutine
+    def poll(self, spawner):
+        """
+        Get the status of a spawner from the most recent sweep
+        """
+        result = self.results.get(spawner)
+        if result is None or time() - result[0] >= self.max_age:
+            yield self.sweep()
+            result = self.results.get(spawner)
+
+        # The server wasn't running when the sweep started
+        if result is None:
+            return (yield spawner.poll_container())
+
+        _, status, exception = result
+        if exception is not None:
+            raise exception
+        return status
+
+    def sweep(self):
+        """
+        Check every running server, sharing a sweep which is already in progress
+        """
+        if self._sweep is None:
+            self._sweep = self.run_sweep()
+
+            def clear_sweep(future):
+                self._sweep = None
+            self._sweep.add_done_callback(clear_sweep)
+
+        return self._sweep
+
+    @gen.coroutine
+    def run_sweep(self):
+        started = time()
+        semaphore = Semaphore(self.concurrency)
+        spawners = [spawner for spawner in list(self.spawners) if spawner.container_id]
+        # Don't queue up more checks behind a server whose last check timed out
+        skipped = [spawner for spawner in spawners if spawner in self.pending]
+        spawners = [spawner for spawner in spawners if spawner not in self.pending]
+        if skipped:
+            self.log.warning("Skipped %d Carina servers whose last check is still running: %s",
+                             len(skipped), ', '.join(spawner.user.name for spawner in skipped))
+        durations = {}
+
+        @gen.coroutine
+        def check(spawner):
+            with (yield semaphore.acquire()):
+                check_started = time()
+                status = exception = None
+                poll = spawner.poll_container(executor=self.executor)
+                try:
+                    status = yield gen.with_timeout(timedelta(seconds=self.timeout), poll)
+                except gen.TimeoutError:
+                    self.log.warning("Timed out polling the Carina server for %s",
+                                     spawner.user.name)
+                    self.pending[spawner] = poll
+                    poll.add_done_callback(lambda future: self.pending.pop(spawner, None))
+                except Exception as e:
+                    exception = e
+
+                durations[spawner.user.name] = time() - check_started
+                self.results[spawner] = (time(), status, exception)
+
+        yield [check(spawner) for spawner in spawners]
+
+        duration = time() - started
+        slowest = sorted(durations.items(), key=lambda item: item[1],
+                         reverse=True)[:self.report_slowest]
+        self.last_sweep = {
+            'started': started,
+            'duration': duration,
+            'servers': len(spawners),
+            'slowest': slowest,
+        }
+        self.log.info("Polled %d Carina servers in %.1fs. Slowest: %s", len(spawners), duration,
+                      ', '.join('{} {:.1f}s'.format(user, seconds) for user, seconds in slowest))
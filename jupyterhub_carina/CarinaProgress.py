@@ -0,0 +1,50 @@
+from tornado.locks import Condition
+
+
+class SpawnProgress:
+    """
+    The progress events of one start of a user's server
+
+    Events are kept until the start is finished, so that every watcher sees all of them,
+    whenever it starts watching.
+    """
+
+    def __init__(self):
+        self.events = []
+        self.finished = False
+        # Set once a start reports to this progress
+        self.claimed = False
+        self._changed = Condition()
+
+    def emit(self, progress, message, **fields):
+        """
+        Record a progress event, with the percentage of the start that is complete
+
+        The percentage never goes down, even when an estimate turns out to be too high.
+        """
+        if self.finished:
+            return
+
+        if self.events:
+            progress = max(progress, self.events[-1]['progress'])
+        event = {'progress': int(progress), 'message': message}
+        event.update(fields)
+        self.events.append(event)
+        self._changed.notify_all()
+
+    def finish(self):
+        self.finished = True
+        self._changed.notify_all()
+
+    async def watch(self):
+        """
+        Yield each event, waiting for new events until the start is finished
+        """
+        index = 0
+        while True:
+            while index < len(self.events):
+                yield self.events[index]
+                index += 1
+            if self.finished:
+                return
+            await self._changed.wait()
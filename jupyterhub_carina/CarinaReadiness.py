@@ -0,0 +1,96 @@
+import abc
+import random
+from tornado import gen
+from traitlets import Bool, Float, MetaHasTraits
+from traitlets.config import LoggingConfigurable
+
+
+class ABCMetaHasTraits(abc.ABCMeta, MetaHasTraits):
+    pass
+
+
+class ClusterReadinessStrategy(LoggingConfigurable, metaclass=ABCMetaHasTraits):
+    """
+    Decides when to poll for a new Carina cluster to become active
+    Subclasses must implement intervals.
+    """
+
+    interval = Float(
+        30,
+        help="The maximum number of seconds between polling for a cluster to become active.",
+        config=True)
+
+    @abc.abstractmethod
+    def intervals(self):
+        """
+        Generate the number of seconds to wait between each poll
+        """
+
+    @gen.coroutine
+    def is_ready(self, carina_client, cluster_name):
+        """
+        Check if the cluster is worth polling for its credentials
+        """
+        return True
+
+
+class FixedIntervalReadiness(ClusterReadinessStrategy):
+    """
+    Poll for the cluster credentials at a fixed interval
+    """
+
+    def intervals(self):
+        while True:
+            yield self.interval
+
+
+class BackoffReadiness(ClusterReadinessStrategy):
+    """
+    Poll quickly at first, then back off exponentially up to the polling interval
+    """
+
+    initial_interval = Float(
+        2,
+        help="The number of seconds before polling for a cluster to become active the second time.",
+        config=True)
+
+    backoff_factor = Float(
+        2,
+        help="The factor applied to the polling interval after each unsuccessful poll.",
+        config=True)
+
+    jitter = Float(
+        0.2,
+        help="The fraction of each polling interval that is randomized, so that clusters "
+             "created at the same time are not polled in lockstep.",
+        config=True)
+
+    check_status = Bool(
+        False,
+        help="Check the cluster status in the cluster listing before requesting its credentials.",
+        config=True)
+
+    def intervals(self):
+        interval = self.initial_interval
+        while True:
+            jittered = interval * random.uniform(1 - self.jitter, 1 + self.jitter)
+            yield min(jittered, self.interval)
+            interval = min(interval * self.backoff_factor, self.interval)
+
+    @gen.coroutine
+    def is_ready(self, carina_client, cluster_name):
+        if not self.check_status:
+            return True
+
+        clusters = yield carina_client.fetch_clusters()
+        cluster = clusters.get(cluster_name)
+        if cluster is None:
+            raise Exception("The {}/{} cluster no longer exists".format(
+                carina_client.user, cluster_name))
+
+        status = cluster.get('status', 'active').lower()
+        if status == 'error':
+            raise Exception("The {}/{} cluster failed to provision".format(
+                carina_client.user, cluster_name))
+
+        return status == 'active'
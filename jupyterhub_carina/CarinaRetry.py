@@ -0,0 +1,168 @@
+import random
+from time import time
+from tornado.httpclient import HTTPError
+from traitlets import Float, Integer
+from traitlets.config import LoggingConfigurable, SingletonConfigurable
+from . import CarinaMetrics as metrics
+
+# Requests which can be repeated without changing the result
+IDEMPOTENT_METHODS = {'GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE'}
+
+# Failures which may go away when the request is repeated. Tornado uses 599 for timeouts
+# and connection errors.
+TRANSIENT_CODES = {429, 500, 502, 503, 504, 599}
+
+
+def error_code(error):
+    """
+    The HTTP status code of a failed request, 599 for connection errors
+    Returns None if the error did not come from the request
+    """
+    if isinstance(error, HTTPError):
+        return error.code
+    if isinstance(error, OSError):
+        return 599
+    return None
+
+
+class CircuitOpenError(Exception):
+    """
+    Raised instead of calling the Carina API while it is failing
+    """
+    pass
+
+
+class RetryPolicy(LoggingConfigurable):
+    """
+    Decides which failed Carina API requests are retried, and how long to wait before each retry
+    """
+
+    max_attempts = Integer(
+        4,
+        help="The maximum number of attempts for each Carina API request. Requests are not "
+             "retried when this is 1.",
+        config=True)
+
+    initial_interval = Float(
+        0.5,
+        help="The number of seconds before the first retry.",
+        config=True)
+
+    max_interval = Float(
+        10,
+        help="The maximum number of seconds between retries.",
+        config=True)
+
+    backoff_factor = Float(
+        2,
+        help="The factor applied to the interval after each retry.",
+        config=True)
+
+    jitter = Float(
+        0.5,
+        help="The fraction of each interval that is randomized, so that requests which failed "
+             "together are not retried in lockstep.",
+        config=True)
+
+    def intervals(self):
+        """
+        Generate the number of seconds to wait before each retry
+        """
+        interval = self.initial_interval
+        while True:
+            yield min(interval * random.uniform(1 - self.jitter, 1 + self.jitter),
+                      self.max_interval)
+            interval = min(interval * self.backoff_factor, self.max_interval)
+
+    def is_transient(self, code):
+        return code in TRANSIENT_CODES
+
+    def should_retry(self, request, code, attempt):
+        """
+        Check if a request which failed with the specified code is worth another attempt
+
+        Requests which aren't idempotent, such as creating a cluster, are never retried here:
+        even a 503 doesn't guarantee that Carina did not process them. Their callers decide
+        whether another attempt is safe.
+        """
+        if attempt >= self.max_attempts or not self.is_transient(code):
+            return False
+        return request.method in IDEMPOTENT_METHODS
+
+    def retry_after(self, response, interval):
+        """
+        Wait at least as long as Carina asked for, up to max_interval
+        """
+        if response is None:
+            return interval
+        try:
+            requested = float(response.headers.get('Retry-After', 0))
+        except ValueError:
+            return interval
+        return max(interval, min(requested, self.max_interval))
+
+
+class CircuitBreaker(SingletonConfigurable):
+    """
+    Fails Carina API requests fast while Carina is failing
+
+    After failure_threshold transient failures in a row, the circuit opens and every request
+    fails immediately with CircuitOpenError. After reset_timeout seconds, a single trial request is
+    let through: the circuit closes again if it succeeds, otherwise it stays open.
+    """
+
+    failure_threshold = Integer(
+        10,
+        help="The number of transient failures in a row before requests to the Carina API "
+             "fail fast. The circuit never opens when this is 0.",
+        config=True)
+
+    reset_timeout = Float(
+        30,
+        help="The number of seconds that requests fail fast, before a trial request is let "
+             "through.",
+        config=True)
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.failures = 0
+        self.opened_at = None
+        self._trial = False
+
+    @property
+    def is_open(self):
+        return self.opened_at is not None
+
+    def check(self):
+        """
+        Raise CircuitOpenError unless a request may be made
+        """
+        if not self.is_open:
+            return
+
+        if not self._trial and time() - self.opened_at >= self.reset_timeout:
+            self.log.info("Sending a trial request to the Carina API")
+            self._trial = True
+            return
+
+        metrics.API_FAST_FAILURES.inc()
+        raise CircuitOpenError("The Carina API failed {} times in a row, retrying in {:.0f}s"
+                               .format(self.failures,
+                                       max(self.opened_at + self.reset_timeout - time(), 0)))
+
+    def record_success(self):
+        if self.is_open:
+            self.log.info("The Carina API recovered, closing the circuit")
+            metrics.API_CIRCUIT_OPEN.set(0)
+        self.failures = 0
+        self.opened_at = None
+        self._trial = False
+
+    def record_failure(self):
+        self.failures += 1
+        if self._trial or (not self.is_open and 0 < self.failure_threshold <= self.failures):
+            self.log.warning("The Carina API failed %d times in a row, failing requests fast "
+                             "for %.0fs", self.failures, self.reset_timeout)
+            metrics.API_CIRCUIT_OPEN.set(1)
+            self.opened_at = time()
+            self._trial = False
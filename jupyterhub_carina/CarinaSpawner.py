@@ -1,11 +1,71 @@
-import docker
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from docker.errors import APIError
 from dockerspawner import DockerSpawner
 import os.path
 import re
 import shutil
+import ssl
+import threading
+from datetime import timedelta
+from time import time
 from tornado import gen
-from traitlets import Dict, Integer, Unicode
+from tornado.ioloop import IOLoop
+from traitlets import Bool, Dict, Enum, Float, Integer, Type, Unicode
+from .CarinaAdmission import CarinaAdmission, SpawnCancelled
+from .CarinaAsyncDocker import AsyncDockerClient
+from .CarinaClusterPool import CarinaClusterPool
+from .CarinaCuller import CarinaCuller
+from .CarinaCredentials import CredentialStorage, CredentialStore, FileCredentialStorage, \
+    install_credentials_async, zip_credentials_async
+from .CarinaDockerPool import DockerClientPool
+from .CarinaImagePull import ImagePullError, ImagePullProgress
+from . import CarinaMetrics as metrics
 from .CarinaOAuthClient import CarinaOAuthClient
+from .CarinaPoller import CarinaPoller
+from .CarinaProgress import SpawnProgress
+from .CarinaReadiness import BackoffReadiness, ClusterReadinessStrategy
+from .CarinaTracing import traced
+
+
+# TLS alerts sent by a cluster which rejected the certificate of the installed credentials
+CERTIFICATE_REJECTIONS = {
+    'SSLV3_ALERT_BAD_CERTIFICATE',
+    'SSLV3_ALERT_CERTIFICATE_EXPIRED',
+    'SSLV3_ALERT_CERTIFICATE_REVOKED',
+    'SSLV3_ALERT_CERTIFICATE_UNKNOWN',
+    'TLSV1_ALERT_UNKNOWN_CA',
+    'TLSV13_ALERT_CERTIFICATE_REQUIRED',
+}
+
+
+def ssl_errors(error):
+    """
+    Generate the SSL errors which caused an error, including those wrapped by requests and urllib3
+    """
+    seen = set()
+    pending = [error]
+    while pending:
+        error = pending.pop()
+        if not isinstance(error, BaseException) or id(error) in seen:
+            continue
+        seen.add(id(error))
+        if isinstance(error, ssl.SSLError):
+            yield error
+        pending.extend([error.__cause__, error.__context__, getattr(error, 'reason', None)])
+        pending.extend(error.args)
+
+
+def _spawner_attributes(spawner, *args, **kwargs):
+    return {'user': spawner.user.name, 'cluster': spawner.cluster_name}
+
+
+def _stage_attributes(spawner, name, stage):
+    return dict(_spawner_attributes(spawner), stage=name)
+
+
+def _docker_attributes(spawner, method, *args, **kwargs):
+    return dict(_spawner_attributes(spawner), **{'docker.method': method})
 
 
 class CarinaSpawner(DockerSpawner):
@@ -25,12 +85,93 @@ class CarinaSpawner(DockerSpawner):
         help="The name of the Jupyter server container running on the user's cluster.",
         config=True)
 
-    cluster_polling_interval = Integer(
+    credentials_root = Unicode(
+        '/root/.carina/clusters',
+        help="The directory where the credentials for each user's cluster are installed.",
+        config=True)
+
+    credential_storage_class = Type(
+        FileCredentialStorage,
+        klass=CredentialStorage,
+        help="Where cluster credentials are persisted, so that they can be reused by other hubs "
+             "or after moving the hub to a new node.",
+        config=True)
+
+    use_cluster_pool = Bool(
+        False,
+        help="Hand out clusters from the CarinaClusterPool to users who do not have a cluster yet.",
+        config=True)
+
+    async_docker = Bool(
+        False,
+        help="Call the Docker API of the user's cluster with Tornado's SimpleAsyncHTTPClient, "
+             "instead of running docker-py in a thread for every call.",
+        config=True)
+
+    async_docker_max_clients = Integer(
+        100,
+        help="The maximum number of concurrent Docker API requests when async_docker is enabled.",
+        config=True)
+
+    batch_poll = Bool(
+        False,
+        help="Poll all running Carina servers together with the CarinaPoller, "
+             "instead of polling each server separately.",
+        config=True)
+
+    cluster_polling_interval = Float(
         30,
-        help="The number of seconds between polling for a user's cluster to become active.",
+        help="The maximum number of seconds between polling for a user's cluster to become active.",
+        config=True
+    )
+
+    cluster_readiness_class = Type(
+        BackoffReadiness,
+        klass=ClusterReadinessStrategy,
+        help="The strategy used to poll for a user's cluster to become active.",
         config=True
     )
 
+    image_pull_policy = Enum(
+        ['always', 'missing', 'background'],
+        'always',
+        help="""When to pull the container_image to the user's cluster.
+        always: pull the image before every start.
+        missing: only pull the image when it is not on the cluster.
+        background: start with the image already on the cluster and pull a newer image in the
+        background, for the next start.
+        When container_image_digest is set, an image with a different digest is always pulled
+        before starting.""",
+        config=True)
+
+    container_image_digest = Unicode(
+        '',
+        help="The expected digest of the container_image, e.g. sha256:abc123.",
+        config=True)
+
+    image_pull_stall_timeout = Integer(
+        120,
+        help="The number of seconds without any progress before pulling the container_image "
+             "is aborted.",
+        config=True)
+
+    image_pull_threads = Integer(
+        4,
+        help="The number of threads which pull images with docker-py. Pulls don't run on "
+             "DockerSpawner's single thread, so that they don't hold up the Docker API calls "
+             "of other starts. Not used with async_docker.",
+        config=True)
+
+    image_pull_report_interval = Integer(
+        10,
+        help="The number of seconds between logging the progress of pulling the container_image.",
+        config=True)
+
+    cluster_liveness_ttl = Integer(
+        30,
+        help="The number of seconds that a cluster which responded to a ping is assumed to still exist.",
+        config=True)
+
     # Override the default timeout to allow extra time for creating the cluster and pulling the
     # server image
     start_timeout = Integer(
@@ -43,70 +184,224 @@ class CarinaSpawner(DockerSpawner):
         {
             'volumes_from': ['swarm-data'],  # --volumes-from swarm-data
             'port_bindings': {8888: None},  # -p 8888:8888
-            'restart_policy': {  # --restart always
+            'restart_policy': {  # --restart unless-stopped
                 'MaximumRetryCount': 0,
-                'Name': 'always'
+                'Name': 'unless-stopped'
             },
         },
         help=DockerSpawner.extra_host_config.help,
         config=True)
 
+    # DOCKER_HOST -> when the cluster last responded to a ping
+    _cluster_liveness = {}
+
+    _pull_executor = None
+
     def __init__(self, **kwargs):
-        # Use a different docker client for each server
-        self._client = None
+        self._async_client = None
         self._carina_client = None
-        self._docker_config = None
+        self._cluster_credentials = None
+        self._cluster_readiness = None
+        self._credential_storage = None
+        self.image_digest = ''
+        self.pull_progress = None
+        self.pooled_cluster = None
+        # What is still warm on the cluster after the server was hibernated
+        self.hibernated = None
+        self.last_started = 0
+        # The user's cluster as of the last time it was verified, so that a restarted hub does
+        # not have to rediscover it
+        self.cluster_record = None
+        self._cluster_from_record = False
+
+        # Startup stages which completed, so that a retried start can resume where it left off
+        self._completed_stages = set()
+        self._stage_results = {}
+        self.stage_timings = OrderedDict()
+        self.spawn_progress = SpawnProgress()
+        self.spawn_progress.finish()
+        # Incremented by each start and stop, so that a start which JupyterHub abandoned, e.g.
+        # after start_timeout, stops instead of interfering with the next start
+        self._start_generation = 0
 
         super().__init__(**kwargs)
 
+        self._default_cluster_name = self.cluster_name
+        if self.use_cluster_pool:
+            self.cluster_pool.start(self.authenticator)
+        if self.batch_poll:
+            self.poller.register(self)
+        if self.culler.enabled:
+            self.culler.register(self)
+
+    @property
+    def client_pool(self):
+        """
+        The Docker clients of every cluster, shared by all spawners
+        """
+        return DockerClientPool.instance(config=self.config)
+
     @property
     def client(self):
         """
         The Docker client used to connect to the user's Carina cluster
+
+        The client is taken from the pool for every call, so that it is health checked and is
+        never one which the pool already dropped.
         """
         # TODO: Figure out how to configure this without overriding, or tweak a bit and call super
-        if self._client is None:
-            creds_dir = self.docker_config['DOCKER_CERT_PATH']
-            api_endpoint = self.docker_config['DOCKER_HOST'].replace("tcp://", "https://")
-            tls_config = docker.tls.TLSConfig(
-                client_cert=(os.path.join(creds_dir, 'cert.pem'),
-                             os.path.join(creds_dir, 'key.pem')),
-                ca_cert=os.path.join(creds_dir, 'ca.pem'),
-                verify=os.path.join(creds_dir, 'ca.pem'),
-                assert_hostname=False)
+        return self.client_pool.get(self.docker_config, self.cluster_credentials.fingerprint)
+
+    @property
+    def async_client(self):
+        """
+        The non-blocking Docker client used to connect to the user's Carina cluster
+        """
+        if self._async_client is None:
+            self._async_client = AsyncDockerClient(self.docker_config,
+                                                   self.cluster_credentials.ssl_context,
+                                                   max_clients=self.async_docker_max_clients)
+
+        return self._async_client
 
-            self._client = docker.Client(version='auto', tls=tls_config, base_url=api_endpoint)
+    @traced('spawner.docker', _docker_attributes)
+    def docker(self, method, *args, executor=None, **kwargs):
+        """
+        Call a docker-py method, using the non-blocking client when async_docker is enabled
+
+        Otherwise the call runs on the executor, when one is given, instead of DockerSpawner's
+        single thread.
+        """
+        if self.async_docker and method in AsyncDockerClient.methods:
+            return getattr(self.async_client, method)(*args, **kwargs)
 
-        return self._client
+        return (executor or self.executor).submit(self._docker, method, *args, **kwargs)
 
     @property
-    def docker_config(self):
+    def credential_store(self):
         """
-        The Docker client configuration variables for the user's Carina cluster
+        The parsed cluster credentials shared by all users
         """
-        if self._docker_config is None:
+        return CredentialStore.instance(config=self.config)
+
+    @property
+    def cluster_credentials(self):
+        """
+        The parsed credentials for the user's Carina cluster
+        """
+        if self._cluster_credentials is None:
             creds_dir = self.get_user_credentials_dir()
-            docker_env = os.path.join(creds_dir, 'docker.env')
-            if not os.path.exists(docker_env):
+            credentials = self.credential_store.get(self.user.name, self.cluster_name, creds_dir)
+            if credentials is None:
                 raise RuntimeError(
                     "ERROR! The credentials for {}/{} could not be found in {}.".format(
                         self.user.name, self.cluster_name, creds_dir))
 
-            with open(docker_env) as f:
-                env = f.read()
+            self._cluster_credentials = credentials
 
-            host = re.findall("DOCKER_HOST=(.*)", env)[0]
-            version = re.findall("DOCKER_VERSION=(.*)", env)[0]
+        return self._cluster_credentials
 
-            self._docker_config = {
-                'DOCKER_HOST': host,
-                'DOCKER_CERT_PATH': creds_dir,
-                'DOCKER_TLS_VERIFY': 1,
-                'DOCKER_VERSION': version,
-            }
+    @property
+    def docker_config(self):
+        """
+        The Docker client configuration variables for the user's Carina cluster
+        """
+        return self.cluster_credentials.docker_config
 
-        return self._docker_config
+    @property
+    def credential_storage(self):
+        """
+        Persists the credentials of the user's cluster
+        """
+        if self._credential_storage is None:
+            self._credential_storage = self.credential_storage_class(parent=self)
+
+        return self._credential_storage
+
+    @gen.coroutine
+    def restore_credentials(self):
+        """
+        Install the credentials for the user's cluster from the credential storage
+        Returns False if they were not stored
+        """
+        credentials_zip = yield self.credential_storage.load_async(self.user.name, self.cluster_name)
+        if credentials_zip is None:
+            return False
+
+        self.log.info("Restoring the stored credentials for {}/{}"
+                      .format(self.user.name, self.cluster_name))
+        yield install_credentials_async(credentials_zip, self.get_user_dir())
+        self.credential_store.invalidate(self.user.name, self.cluster_name)
+        return (yield self.prepare_docker_config())
+
+    @gen.coroutine
+    def prepare_docker_config(self):
+        """
+        Load the credentials for the user's Carina cluster without blocking
+        Returns False if the credentials don't exist
+        """
+        if self._cluster_credentials is None:
+            self._cluster_credentials = yield self.credential_store.load(
+                self.user.name, self.cluster_name, self.get_user_credentials_dir())
+
+        return self._cluster_credentials is not None
+
+    @property
+    def cluster_readiness(self):
+        """
+        The strategy used to poll for the user's cluster to become active
+        """
+        if self._cluster_readiness is None:
+            self._cluster_readiness = self.cluster_readiness_class(
+                interval=self.cluster_polling_interval, parent=self)
+
+        return self._cluster_readiness
+
+    @property
+    def cluster_pool(self):
+        """
+        The pool of ready clusters shared by all users
+        """
+        return CarinaClusterPool.instance(config=self.config)
+
+    @property
+    def poller(self):
+        """
+        Polls all running Carina servers together
+        """
+        return CarinaPoller.instance(config=self.config)
+
+    @property
+    def pull_executor(self):
+        """
+        The threads which pull images with docker-py, shared by all spawners
+        """
+        cls = self.__class__
+        if cls._pull_executor is None:
+            cls._pull_executor = ThreadPoolExecutor(self.image_pull_threads)
+
+        return cls._pull_executor
+
+    @property
+    def admission(self):
+        """
+        Limits the spawns, Carina API calls and image pulls of the whole hub
+        """
+        return CarinaAdmission.instance(config=self.config)
 
+    @property
+    def queue_position(self):
+        """
+        The position of this spawn in the queue for a spawn slot, 0 when it is not waiting
+        """
+        return self.admission.queue_position(self)
+
+    @property
+    def culler(self):
+        """
+        Hibernates idle Carina servers
+        """
+        return CarinaCuller.instance(config=self.config)
 
     @property
     def carina_client(self):
@@ -116,10 +411,21 @@ class CarinaSpawner(DockerSpawner):
             cfg = self.authenticator
             self._carina_client = CarinaOAuthClient(cfg.client_id, cfg.client_secret,
                                                     cfg.oauth_callback_url,
-                                                    user=self.user.name)
+                                                    user=self.user.name, parent=self)
 
         return self._carina_client
 
+    @property
+    def cluster_client(self):
+        """
+        The Carina client of the account which owns the user's cluster: the cluster pool's account
+        for a cluster handed out by the pool, otherwise the user's own
+        Returns None if the pool is not running
+        """
+        if self.pooled_cluster:
+            return self.cluster_pool.carina_client
+        return self.carina_client
+
     def get_state(self):
         self.log.debug("Saving state for %s", self.user.name)
         state = super().get_state()
@@ -127,6 +433,15 @@ class CarinaSpawner(DockerSpawner):
             state['access_token'] = self.carina_client.credentials.access_token
             state['refresh_token'] = self.carina_client.credentials.refresh_token
             state['expires_at'] = self.carina_client.credentials.expires_at
+            state['token_lifetime'] = self.carina_client.credentials.lifetime
+        if self.image_digest:
+            state['image_digest'] = self.image_digest
+        if self.pooled_cluster:
+            state['pooled_cluster'] = self.pooled_cluster
+        if self.hibernated:
+            state['hibernated'] = self.hibernated
+        if self.cluster_record:
+            state['cluster'] = self.cluster_record
 
         return state
 
@@ -137,9 +452,78 @@ class CarinaSpawner(DockerSpawner):
         access_token = state.get('access_token', None)
         refresh_token = state.get('refresh_token', None)
         expires_at = state.get('expires_at', None)
+        lifetime = state.get('token_lifetime', None)
         if access_token:
             self.log.debug("Loading users's oauth credentials")
-            self.carina_client.load_credentials(access_token, refresh_token, expires_at)
+            self.carina_client.load_credentials(access_token, refresh_token, expires_at, lifetime)
+
+        self.image_digest = state.get('image_digest', '')
+
+        self.pooled_cluster = state.get('pooled_cluster', None)
+        if self.pooled_cluster:
+            self.cluster_name = self.pooled_cluster['name']
+
+        self.hibernated = state.get('hibernated', None)
+        self.cluster_record = self.validate_cluster_record(state.get('cluster', None))
+        if self.container_id:
+            # The server has been running since before the hub restarted
+            self.last_started = time()
+
+    def validate_cluster_record(self, record):
+        """
+        Check a cluster record loaded from the spawner state
+        Returns None if it is missing, malformed or for another cluster
+        """
+        if record is None:
+            return None
+
+        try:
+            valid = (
+                record['name'] == self.cluster_name and
+                (record['id'] is None or isinstance(record['id'], str)) and
+                record['docker_host'].startswith('tcp://') and
+                re.match('^[0-9a-f]{64}$', record['fingerprint']) is not None and
+                0 <= record['verified_at'] <= time() + 60)
+        except (KeyError, TypeError, AttributeError):
+            valid = False
+
+        if not valid:
+            self.log.warning("Ignoring the invalid cluster record for {}: {}"
+                             .format(self.user.name, record))
+            return None
+        return record
+
+    def record_cluster(self, cluster_id=None):
+        """
+        Record the user's cluster, with the credentials that are installed for it
+        """
+        previous = self.cluster_record or {}
+        if previous.get('name') != self.cluster_name:
+            previous = {}
+
+        host = self.docker_config['DOCKER_HOST']
+        self.cluster_record = {
+            'id': cluster_id or previous.get('id'),
+            'name': self.cluster_name,
+            'docker_host': host,
+            'fingerprint': self.cluster_credentials.fingerprint,
+            'verified_at': self._cluster_liveness.get(host, previous.get('verified_at', 0)),
+        }
+
+    def use_recorded_cluster(self):
+        """
+        Use the recorded cluster id instead of looking the cluster up in the user's listing
+        A cluster handed out by the pool is always recorded.
+        Returns False if there is no usable record
+        """
+        record = self.cluster_record or self.pooled_cluster
+        if not record or not record['id'] or record['name'] != self.cluster_name:
+            return False
+
+        self._stage_results['cluster'] = {'id': record['id'], 'name': record['name']}
+        self._completed_stages.add('cluster')
+        self._cluster_from_record = True
+        return True
 
     def clear_state(self):
         self.log.debug("Clearing state")
@@ -149,13 +533,95 @@ class CarinaSpawner(DockerSpawner):
         self.container_id = ''
 
     @gen.coroutine
-    def get_container(self):
-        if not (yield self.cluster_exists()):
+    def get_container(self, executor=None):
+        """
+        Inspect the user's container, running the docker-py calls on the executor, if one is given
+        Returns None if the cluster or the container is gone
+        """
+        if not (yield self.cluster_exists(executor)):
             return None
 
-        container = yield super().get_container()
+        self.log.debug("Getting container '%s'", self.container_name)
+        try:
+            container = yield self.docker('inspect_container', self.container_name,
+                                          executor=executor)
+            self.container_id = container['Id']
+        except APIError as e:
+            if e.response.status_code not in (404, 500):
+                raise
+            # The container is gone, or on an unhealthy node
+            self.log.info("Container '%s' is gone (%s)", self.container_name,
+                          e.response.status_code)
+            container = None
+            self.container_id = ''
         return container
 
+    @gen.coroutine
+    def poll(self):
+        if not self.batch_poll:
+            return (yield self.poll_container())
+
+        return (yield self.poller.poll(self))
+
+    @gen.coroutine
+    def poll_container(self, executor=None):
+        """
+        Check the status of the user's container
+
+        The docker-py calls run on the executor, when one is given, instead of DockerSpawner's
+        single thread.
+        """
+        container = yield self.get_container(executor)
+        if not container:
+            self.log.warning("container not found")
+            return 0
+
+        state = container['State']
+        if state['Running']:
+            return None
+        return "ExitCode={ExitCode}, Error='{Error}', FinishedAt={FinishedAt}".format(**state)
+
+    @gen.coroutine
+    def stop(self, now=False):
+        self._start_generation += 1
+        self.admission.cancel_spawn(self)
+        yield super().stop(now=now)
+        self.poller.forget(self)
+
+    @gen.coroutine
+    def hibernate(self):
+        """
+        Stop the user's container, keeping their cluster, credentials and image for the next start
+
+        JupyterHub notices that the server stopped the next time it is polled.
+        """
+        self.log.info("Hibernating the idle server for {}".format(self.user.name))
+        yield self.docker('stop', self.container_id)
+        self.hibernated = {
+            'cluster': self.cluster_name,
+            'container_image': self.container_image,
+            'image_digest': self.image_digest,
+            'at': time(),
+        }
+        self.poller.forget(self)
+
+    def resume_hibernated(self):
+        """
+        Skip pulling the image when resuming a hibernated server, if it is still current
+        """
+        hibernated = self.hibernated
+        if not hibernated or hibernated['cluster'] != self.cluster_name:
+            return
+
+        pinned_digest = self.container_image_digest.split('@')[-1]
+        if hibernated['container_image'] != self.container_image or \
+                (pinned_digest and hibernated['image_digest'] != pinned_digest):
+            return
+
+        self.log.info("Resuming the hibernated server for {}".format(self.user.name))
+        self.image_digest = hibernated['image_digest']
+        self._completed_stages.add('image')
+
     def get_env(self):
         env = super().get_env()
 
@@ -167,81 +633,564 @@ class CarinaSpawner(DockerSpawner):
 
         return env
 
+    def run_pre_spawn_hook(self):
+        self.request_spawn_progress()
+        return super().run_pre_spawn_hook()
+
+    def request_spawn_progress(self):
+        """
+        Replace the progress of the previous start, as soon as a new start is requested, so that
+        watchers don't replay the previous start's events
+        """
+        if self.spawn_progress.claimed or self.spawn_progress.finished:
+            self.spawn_progress = SpawnProgress()
+        return self.spawn_progress
+
+    def check_start(self, generation):
+        """
+        Abort a start which was abandoned by a stop or a newer start
+        """
+        if generation != self._start_generation:
+            raise SpawnCancelled("The start of the server for {} was abandoned"
+                                 .format(self.user.name))
+
+    @traced('spawner.start', _spawner_attributes)
     @gen.coroutine
     def start(self):
+        started = self.last_started = time()
+        self._start_generation += 1
+        generation = self._start_generation
+        progress = self.request_spawn_progress()
+        progress.claimed = True
+        timings = self.stage_timings = OrderedDict()
         try:
+            yield self.wait_for_spawn_slot(progress, timings)
+        except Exception:
+            progress.finish()
+            raise
+        metrics.SPAWNS_IN_PROGRESS.inc()
+        try:
+            self.check_start(generation)
             self.log.info("Creating infrastructure for {}...".format(self.user.name))
-            cluster = yield self.create_cluster()
-            yield self.download_cluster_credentials(cluster['id'])
-            yield self.pull_user_image()
+            self.poller.forget(self)
+
+            self._cluster_from_record = False
+            if (yield self.cluster_exists()):
+                self.log.info("Found credentials for the {}/{} cluster"
+                              .format(self.user.name, self.cluster_name))
+                self._completed_stages.update(['cluster', 'credentials'])
+                self.resume_hibernated()
+                progress.emit(10, "Found your cluster {}".format(self.cluster_name),
+                              stage='cluster')
+            elif self.use_recorded_cluster():
+                self.log.info("Using the recorded {}/{} cluster ({})".format(
+                    self.user.name, self.cluster_name, self._stage_results['cluster']['id']))
+                progress.emit(10, "Found your cluster {}".format(self.cluster_name),
+                              stage='cluster')
+            elif self.use_cluster_pool and (yield self.acquire_pooled_cluster()):
+                self.log.info("Using pooled cluster {} for {}"
+                              .format(self.cluster_name, self.user.name))
+                progress.emit(10, "Assigned the ready cluster {} to you"
+                              .format(self.cluster_name), stage='cluster')
+            else:
+                # Look up the swarm template while searching for an existing cluster
+                self.carina_client.warm_swarm_template()
+
+            cluster = yield self.connect_cluster(progress, generation)
+            yield self.prepare_docker_config()
+            self.record_cluster(cluster['id'] if cluster else None)
+            progress.emit(50, "Connected to your cluster {}".format(self.cluster_name),
+                          stage='credentials')
+            yield self.run_stage('image', lambda: self.pull_user_image(progress), generation)
 
             self.log.info("Starting container for {}...".format(self.user.name))
-            yield super().start()
+            progress.emit(90, "Starting your server", stage='container')
+            result = yield self.run_stage('container', super().start, generation)
+            self.poller.forget(self)
+
+            # Always check for a newer image on the next start
+            self._completed_stages.difference_update(['image', 'container'])
+            self.hibernated = None
+            self.last_started = time()
+
+            # The container started, so the cluster is alive
+            self._cluster_liveness[self.docker_config['DOCKER_HOST']] = self.last_started
+            self.record_cluster()
 
-            self.log.debug('Startup for {} is complete!'.format(self.user.name))
+            self.log.info('Startup for {} is complete! ({})'.format(
+                self.user.name,
+                ', '.join('{} {:.1f}s'.format(stage, duration)
+                          for stage, duration in timings.items())))
+            metrics.SPAWN_DURATION.labels(status='success').observe(time() - started)
+            return result
         except Exception:
+            if generation == self._start_generation and self._cluster_from_record and \
+                    'credentials' not in self._completed_stages:
+                # The recorded cluster may be gone, look it up again on the next start
+                self.cluster_record = None
+                self._completed_stages.discard('cluster')
             self.log.exception('Startup for {} failed!'.format(self.user.name))
+            metrics.SPAWN_DURATION.labels(status='failure').observe(time() - started)
+            raise
+        finally:
+            metrics.SPAWNS_IN_PROGRESS.dec()
+            self.admission.release_spawn()
+            progress.finish()
+
+    async def progress(self):
+        """
+        Yield the progress events of the server being started, for the spawn pending page of
+        JupyterHub 0.9 and later
+        """
+        async for event in self.spawn_progress.watch():
+            yield event
+
+    @gen.coroutine
+    def wait_for_spawn_slot(self, progress, timings):
+        """
+        Wait in the hub-wide queue of spawns, when CarinaAdmission.max_concurrent_spawns is reached
+        """
+        queued = time()
+        slot = self.admission.acquire_spawn(self)
+        if not slot.done():
+            position = None
+            while not slot.done():
+                if self.queue_position != position:
+                    position = self.queue_position
+                    progress.emit(0, "Waiting to start your server, number {} in the queue"
+                                  .format(position), stage='queue', queue_position=position)
+                try:
+                    yield gen.with_timeout(timedelta(seconds=1), slot,
+                                           quiet_exceptions=SpawnCancelled)
+                except gen.TimeoutError:
+                    pass
+
+            yield slot
+            timings['queue'] = time() - queued
+            self.log.info("Admitted the spawn for {} after {:.1f}s in the queue"
+                          .format(self.user.name, timings['queue']))
+
+    @gen.coroutine
+    def connect_cluster(self, progress, generation):
+        """
+        Find or create the user's cluster, and download its credentials
+
+        A recorded cluster may have been deleted outside of the hub. When its credentials can't be
+        downloaded and Carina no longer lists it, the cluster is looked up or created again
+        within the same start.
+        """
+        cluster = yield self.run_stage('cluster', lambda: self.create_cluster(progress),
+                                       generation)
+        try:
+            yield self.run_stage(
+                'credentials', lambda: self.download_cluster_credentials(cluster['id'], progress),
+                generation)
+            return cluster
+        except SpawnCancelled:
             raise
+        except Exception as e:
+            if not self._cluster_from_record or not (yield self.recorded_cluster_is_gone(cluster)):
+                raise
+            self.check_start(generation)
+            self.log.warning("The recorded {}/{} cluster is gone, looking it up again: {}"
+                             .format(self.user.name, self.cluster_name, e))
+
+        self._cluster_from_record = False
+        self.cluster_record = None
+        if self.pooled_cluster:
+            self.pooled_cluster = None
+            self.cluster_name = self._default_cluster_name
+        self._completed_stages.discard('cluster')
+        self._stage_results.pop('cluster', None)
+        self.carina_client.warm_swarm_template()
+
+        cluster = yield self.run_stage('cluster', lambda: self.create_cluster(progress),
+                                       generation)
+        yield self.run_stage(
+            'credentials', lambda: self.download_cluster_credentials(cluster['id'], progress),
+            generation)
+        return cluster
 
     @gen.coroutine
-    def create_cluster(self):
+    def recorded_cluster_is_gone(self, cluster):
+        """
+        Check if Carina no longer lists the recorded cluster, or lists a different cluster under
+        its name. Returns False when that is unknown.
         """
-        Create a Carina cluster
+        client = self.cluster_client
+        if client is None or client.credentials is None:
+            return False
+        try:
+            client.invalidate_clusters()
+            listed = yield client.get_cluster(cluster['name'])
+        except Exception as e:
+            self.log.warning("Unable to check if the {}/{} cluster exists: {}"
+                             .format(self.user.name, cluster['name'], e))
+            return False
+        return listed is None or listed['id'] != cluster['id']
+
+    @gen.coroutine
+    def acquire_pooled_cluster(self):
+        """
+        Take over a ready cluster from the cluster pool
+        The cluster still belongs to the pool's Carina account, and its credentials are saved to
+        the credential storage like those of a cluster created for the user.
+        Returns False if the pool is empty
+        """
+        if self.pooled_cluster:
+            # The previously pooled cluster is gone
+            self.pooled_cluster = None
+            self.cluster_name = self._default_cluster_name
+
+        cluster = self.cluster_pool.acquire()
+        if cluster is None:
+            self.log.info("The cluster pool is empty, creating a cluster for {}"
+                          .format(self.user.name))
+            return False
+
+        self.cluster_name = cluster['name']
+        credentials_dir = self.get_user_credentials_dir()
+        os.makedirs(os.path.dirname(credentials_dir), exist_ok=True)
+        os.rename(cluster['credentials_dir'], credentials_dir)
+        self._async_client = None
+        self._cluster_credentials = None
+
+        self.pooled_cluster = {'id': cluster['id'], 'name': cluster['name']}
+        self._stage_results['cluster'] = self.pooled_cluster
+        self._completed_stages.update(['cluster', 'credentials'])
+        if cluster['container_image'] == self.container_image:
+            self._completed_stages.add('image')
+
+        credentials_zip = yield zip_credentials_async(credentials_dir)
+        yield self.credential_storage.save_async(self.user.name, self.cluster_name,
+                                                 credentials_zip)
+        return True
+
+    @traced('spawner.stage', _stage_attributes)
+    @gen.coroutine
+    def run_stage(self, name, stage, generation):
+        """
+        Run a startup stage of the start with the specified generation, and record how long it took
+
+        Stages which completed during an earlier, failed, start are skipped. A start which was
+        abandoned in the meantime is aborted, without recording the stage.
+        """
+        self.check_start(generation)
+        if name in self._completed_stages:
+            self.log.debug("Skipping the {} stage for {}, it is already complete"
+                           .format(name, self.user.name))
+            return self._stage_results.get(name)
+
+        started = time()
+        result = yield stage()
+        self.check_start(generation)
+        self.stage_timings[name] = time() - started
+        metrics.SPAWN_STAGE_DURATION.labels(stage=name).observe(self.stage_timings[name])
+        self._stage_results[name] = result
+        self._completed_stages.add(name)
+        return result
+
+    @traced('spawner.create_cluster', _spawner_attributes)
+    @gen.coroutine
+    def create_cluster(self, progress):
+        """
+        Create a Carina cluster, reporting to the progress of the start
         Returns existing cluster if one with the same name is already present
         """
         cluster = yield self.carina_client.get_cluster(self.cluster_name)
         if cluster is not None:
             self.log.info("Found existing cluster: {}/{}".format(self.user.name, self.cluster_name))
+            progress.emit(10, "Found your cluster {}".format(self.cluster_name), stage='cluster')
             return cluster
 
         self.log.info("Creating cluster {}/{}".format(self.user.name, self.cluster_name))
-        return (yield self.carina_client.create_cluster(self.cluster_name))
+        progress.emit(5, "Creating your cluster {}".format(self.cluster_name), stage='cluster')
+        cluster = yield self.carina_client.create_cluster(self.cluster_name)
+        progress.emit(15, "Created your cluster {}".format(self.cluster_name), stage='cluster')
+        return cluster
 
+    @traced('spawner.download_cluster_credentials', _spawner_attributes)
     @gen.coroutine
-    def download_cluster_credentials(self, cluster_id):
+    def download_cluster_credentials(self, cluster_id, progress):
         """
-        Download the cluster credentials
+        Download the cluster credentials, reporting to the progress of the start
         """
-        credentials_dir = self.get_user_credentials_dir()
-        if os.path.exists(credentials_dir):
+        if (yield self.prepare_docker_config()) or (yield self.restore_credentials()):
             return
 
         self.log.info("Downloading cluster credentials for {}/{} ({})..."
                       .format(self.user.name, self.cluster_name, cluster_id))
-        user_dir = "/root/.carina/clusters/{}".format(self.user.name)
-        yield self.carina_client.download_cluster_credentials(cluster_id, self.cluster_name,
-                                                              user_dir,
-                                                              self.cluster_polling_interval)
+        def report_attempt(attempt, wait):
+            progress.emit(min(15 + 3 * attempt, 45),
+                          "Waiting for your cluster {} to become active ({:.0f}s, attempt {})"
+                          .format(self.cluster_name, wait, attempt),
+                          stage='credentials', attempt=attempt)
 
+        client = self.cluster_client
+        if client is None:
+            raise RuntimeError("The cluster pool, which owns the {}/{} cluster, is not running"
+                               .format(self.user.name, self.cluster_name))
+        result = yield client.download_cluster_credentials(
+            cluster_id, self.cluster_name, self.get_user_dir(), readiness=self.cluster_readiness,
+            on_attempt=report_attempt)
+        self.credential_store.invalidate(self.user.name, self.cluster_name)
+        yield self.credential_storage.save_async(self.user.name, self.cluster_name,
+                                                 result['credentials_zip'])
+
+    @traced('spawner.cluster_exists', _spawner_attributes)
     @gen.coroutine
-    def cluster_exists(self):
+    def cluster_exists(self, executor=None):
         """
-        Safely check if the user's cluster exists
+        Safely check if the user's cluster exists, pinging it on the executor, if one is given
+
+        A cluster which responded within the last cluster_liveness_ttl seconds is not checked again.
+        The stored credentials are only deleted when the cluster is known to be gone, not when it
+        merely failed to respond.
         """
-        credentials_dir = self.get_user_credentials_dir()
-        if not os.path.exists(credentials_dir):
+        try:
+            if not ((yield self.prepare_docker_config()) or (yield self.restore_credentials())):
+                return False
+        except Exception as e:
+            self.log.warning("Unable to load the credentials for {}/{}: {}"
+                             .format(self.user.name, self.cluster_name, e))
+            yield self.discard_cluster_credentials(delete_stored=False)
             return False
 
         try:
-            yield self.docker('info')
+            host = self.docker_config['DOCKER_HOST']
+            last_seen = self._cluster_liveness.get(host, 0)
+            record = self.cluster_record
+            if record and record['docker_host'] == host and \
+                    record['fingerprint'] == self.cluster_credentials.fingerprint:
+                # Trust the record after a hub restart
+                last_seen = max(last_seen, record['verified_at'])
+            if time() - last_seen < self.cluster_liveness_ttl:
+                return True
+
+            yield self.docker('ping', executor=executor)
+            self._cluster_liveness[host] = time()
+            self.record_cluster()
             return True
-        except Exception:
-            # Remove old credentials now that they no longer work
-            shutil.rmtree(credentials_dir, ignore_errors=True)
-            self._client = None
+        except Exception as e:
+            gone = yield self.cluster_is_gone(e)
+            self.log.warning("The {}/{} cluster did not respond{}: {}".format(
+                self.user.name, self.cluster_name, ", it is gone" if gone else "", e))
+            yield self.discard_cluster_credentials(delete_stored=gone)
+            return False
+
+    @gen.coroutine
+    def cluster_is_gone(self, error):
+        """
+        Check if a failed ping means that the user's cluster no longer exists
+
+        Carina is always asked whether the cluster is still listed. A listed cluster is only gone
+        when it was replaced: it has a different id than the recorded one, or it rejected the
+        certificate of the installed credentials. Any other SSL error may be a problem on the
+        hub itself. Returns False when that is unknown.
+        """
+        rejected = any(getattr(e, 'reason', None) in CERTIFICATE_REJECTIONS
+                       for e in ssl_errors(error))
+
+        client = self.cluster_client
+        if client is None or client.credentials is None:
             return False
+        try:
+            client.invalidate_clusters()
+            cluster = yield client.get_cluster(self.cluster_name)
+        except Exception as e:
+            self.log.warning("Unable to check if the {}/{} cluster exists: {}"
+                             .format(self.user.name, self.cluster_name, e))
+            return False
+
+        if cluster is None:
+            return True
+        record = self.cluster_record
+        if record and record['id'] and record['id'] != cluster['id']:
+            return True
+        return rejected
+
+    @gen.coroutine
+    def discard_cluster_credentials(self, delete_stored):
+        """
+        Forget the credentials of the user's cluster on this hub, and optionally delete them from
+        the credential storage, which other hubs may share
+        """
+        self.cluster_record = None
+        if self._cluster_credentials is not None:
+            self._cluster_liveness.pop(self.docker_config['DOCKER_HOST'], None)
+            self.client_pool.discard(self.docker_config, self._cluster_credentials.fingerprint)
+        # Remove old credentials now that they no longer work
+        shutil.rmtree(self.get_user_credentials_dir(), ignore_errors=True)
+        self.credential_store.invalidate(self.user.name, self.cluster_name)
+        self._async_client = None
+        self._cluster_credentials = None
+        self._completed_stages.clear()
+
+        if delete_stored:
+            try:
+                yield self.credential_storage.delete_async(self.user.name, self.cluster_name)
+            except Exception as e:
+                self.log.warning("Unable to delete the stored credentials for {}/{}: {}"
+                                 .format(self.user.name, self.cluster_name, e))
+            if self.pooled_cluster:
+                # The pooled cluster is gone, the user gets a new cluster on the next start
+                self.pooled_cluster = None
+                self.cluster_name = self._default_cluster_name
 
+    @traced('spawner.pull_user_image', _spawner_attributes)
     @gen.coroutine
-    def pull_user_image(self):
+    def pull_user_image(self, spawn_progress):
         """
-        Pull the user image to the cluster
+        Pull the user image to the cluster, according to the image_pull_policy
         """
+        if self.image_pull_policy != 'always':
+            digest = yield self.get_image_digest()
+            pinned_digest = self.container_image_digest.split('@')[-1]
+            if digest is not None and (not pinned_digest or digest == pinned_digest):
+                self.image_digest = digest
+                if self.image_pull_policy == 'background':
+                    self.log.debug("Pulling {} to the {}/{} cluster in the background..."
+                                   .format(self.container_image, self.user.name, self.cluster_name))
+                    IOLoop.current().add_future(self.docker_pull(), self._log_background_pull)
+                else:
+                    self.log.debug("Skipped pulling {} ({}), it is already on the {}/{} cluster"
+                                   .format(self.container_image, digest, self.user.name,
+                                           self.cluster_name))
+                return
+
+        yield self.docker_pull(spawn_progress)
+
+    @traced('spawner.docker_pull', _spawner_attributes)
+    @gen.coroutine
+    def docker_pull(self, spawn_progress=None):
+        """
+        Pull the user image to the cluster and record its digest
+        The progress of the pull is reported to the spawn_progress of a start waiting for it.
+        """
+        delay = self.admission.reserve('pull')
+        if delay:
+            self.log.info("Delaying pulling {} to the {}/{} cluster by {:.1f}s".format(
+                self.container_image, self.user.name, self.cluster_name, delay))
+            yield gen.sleep(delay)
+
         self.log.debug("Starting to pull {} to the {}/{} cluster..."
                        .format(self.container_image, self.user.name, self.cluster_name))
-        yield self.docker("pull", self.container_image)
-        self.log.debug("Finished pulling {} to the {}/{} cluster..."
-                       .format(self.container_image, self.user.name, self.cluster_name))
+        progress = self.pull_progress = ImagePullProgress(self.container_image)
+        loop = IOLoop.current()
+        cancelled = threading.Event()
+
+        def check_cancelled(event):
+            if cancelled.is_set():
+                raise ImagePullError("Pulling {} was cancelled".format(self.container_image))
+
+        def stream_pull():
+            for event in self.client.pull(self.container_image, stream=True, decode=True):
+                if 'error' in event:
+                    raise ImagePullError(event['error'])
+                check_cancelled(event)
+                loop.add_callback(self.record_pull_event, progress, event, spawn_progress)
+
+        def on_event(event):
+            check_cancelled(event)
+            self.record_pull_event(progress, event, spawn_progress)
+
+        metrics.IMAGE_PULLS_IN_PROGRESS.inc()
+        if self.async_docker:
+            pull = self.async_client.pull(self.container_image, callback=on_event)
+        else:
+            pull = self.pull_executor.submit(stream_pull)
+        try:
+            while True:
+                try:
+                    yield gen.with_timeout(timedelta(seconds=self.image_pull_report_interval), pull)
+                    break
+                except gen.TimeoutError:
+                    pass
+
+                if progress.stalled_for() > self.image_pull_stall_timeout:
+                    cancelled.set()
+                    raise ImagePullError("Pulling {} to the {}/{} cluster stalled at {}".format(
+                        self.container_image, self.user.name, self.cluster_name,
+                        progress.describe()))
+
+                self.log.info("Pulling {} to the {}/{} cluster: {}".format(
+                    self.container_image, self.user.name, self.cluster_name, progress.describe()))
+        except Exception:
+            metrics.IMAGE_PULL_DURATION.labels(status='failure').observe(time() - progress.started)
+            raise
+        finally:
+            metrics.IMAGE_PULLS_IN_PROGRESS.dec()
+
+        progress.finish()
+        metrics.IMAGE_PULL_DURATION.labels(status='success').observe(progress.finished -
+                                                                     progress.started)
+        self.image_digest = (yield self.get_image_digest()) or ''
+        self.log.debug("Finished pulling {} ({}) to the {}/{} cluster in {:.1f}s: {}"
+                       .format(self.container_image, self.image_digest, self.user.name,
+                               self.cluster_name, progress.finished - progress.started,
+                               ', '.join('{} {:.1f}s'.format(layer_id, duration) for
+                                         layer_id, duration in progress.layer_timings().items())))
+
+        pinned_digest = self.container_image_digest.split('@')[-1]
+        if pinned_digest and self.image_digest != pinned_digest:
+            self.log.warning("The digest of {} is {}, expected {}".format(
+                self.container_image, self.image_digest, pinned_digest))
+
+    def record_pull_event(self, progress, event, spawn_progress=None):
+        """
+        Apply an event from the docker pull stream, and report the progress of a pull that the
+        start is waiting for
+        """
+        percent = progress.percent
+        downloaded = progress.bytes_downloaded
+        completed = progress.layers_completed
+        progress.update(event)
+
+        if progress.bytes_downloaded > downloaded:
+            metrics.IMAGE_PULL_BYTES.inc(progress.bytes_downloaded - downloaded)
+        if progress.layers_completed > completed:
+            status = 'cached' if event.get('status') == 'Already exists' else 'pulled'
+            metrics.IMAGE_PULL_LAYERS.labels(status=status).inc()
+        if progress.percent != percent and spawn_progress is not None:
+            spawn_progress.emit(50 + 0.35 * progress.percent, "Pulling {}: {}".format(
+                self.container_image, progress.describe()), stage='image',
+                percent=progress.percent)
+
+    def _log_background_pull(self, future):
+        if future.exception() is not None:
+            self.log.warning("Unable to pull {} to the {}/{} cluster in the background: {}"
+                             .format(self.container_image, self.user.name, self.cluster_name,
+                                     future.exception()))
+
+    @gen.coroutine
+    def get_image_digest(self):
+        """
+        Get the digest of the user image on the cluster
+        Returns None if the image isn't on the cluster
+        """
+        try:
+            image = yield self.docker('inspect_image', self.container_image)
+        except APIError as e:
+            if e.response.status_code == 404:
+                return None
+            raise
+
+        # Prefer the registry digest, images which were never pushed only have an id
+        repository, _, tag = self.container_image.rpartition(':')
+        if not repository or '/' in tag:
+            repository = self.container_image
+        repo_digests = image.get('RepoDigests') or []
+        for repo_digest in repo_digests:
+            if repo_digest.split('@')[0] == repository:
+                return repo_digest.split('@')[-1]
+        if repo_digests:
+            return repo_digests[0].split('@')[-1]
+
+        return image['Id']
+
+    def get_user_dir(self):
+        return os.path.join(self.credentials_root, self.user.name)
 
     def get_user_credentials_dir(self):
-        credentials_dir = "/root/.carina/clusters/{}/{}".format(self.user.name, self.cluster_name)
+        credentials_dir = os.path.join(self.get_user_dir(), self.cluster_name)
         return credentials_dir
@@ -0,0 +1,161 @@
+"""
+Opt-in tracing of logins and spawns
+
+Each traced coroutine is recorded as a timed span. Spans started while another span is in
+progress, in the same chain of coroutines, belong to the same trace. Finished spans are appended
+to a JSON lines file, using the field names of the OpenTelemetry span format.
+"""
+import functools
+import json
+import os
+import threading
+from time import time
+from uuid import uuid4
+from traitlets import Bool, Unicode
+from traitlets.config import SingletonConfigurable
+
+try:
+    import contextvars
+except ImportError:
+    contextvars = None
+
+if contextvars is not None:
+    _current_span = contextvars.ContextVar('carina_span', default=None)
+else:
+    _current_span = None
+
+
+class Span:
+    """
+    A timed operation within a trace
+    """
+
+    def __init__(self, name, parent=None, attributes=None):
+        self.name = name
+        self.trace_id = parent.trace_id if parent is not None else uuid4().hex
+        self.span_id = uuid4().hex[:16]
+        self.parent_id = parent.span_id if parent is not None else None
+        self.attributes = dict(parent.inherited) if parent is not None else {}
+        self.attributes.update(attributes or {})
+        self.start = time()
+        self.end = None
+        self.error = None
+
+    @property
+    def inherited(self):
+        """
+        The attributes which are copied to child spans
+        """
+        return {key: value for key, value in self.attributes.items() if key == 'user'}
+
+    def finish(self, error=None):
+        self.end = time()
+        if error is not None:
+            self.error = '{}: {}'.format(type(error).__name__, error)
+
+    def to_dict(self):
+        return {
+            'traceId': self.trace_id,
+            'spanId': self.span_id,
+            'parentSpanId': self.parent_id,
+            'name': self.name,
+            'startTimeUnixNano': int(self.start * 1e9),
+            'endTimeUnixNano': int(self.end * 1e9),
+            'durationMs': round((self.end - self.start) * 1000, 3),
+            'attributes': self.attributes,
+            'status': {'code': 'ERROR', 'message': self.error} if self.error else {'code': 'OK'},
+        }
+
+
+class CarinaTracer(SingletonConfigurable):
+    """
+    Records spans and writes them to a JSON lines file
+    """
+
+    enabled = Bool(
+        False,
+        help="Trace logins and spawns. Requires Python 3.7 and Tornado 6.",
+        config=True)
+
+    path = Unicode(
+        '/root/.carina/traces.jsonl',
+        help="The file that finished spans are appended to, one JSON object per line.",
+        config=True)
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self._file = None
+        self._lock = threading.Lock()
+        if self.enabled and contextvars is None:
+            self.log.warning("Tracing requires contextvars, which is not available")
+            self.enabled = False
+
+    def start_span(self, name, attributes=None):
+        return Span(name, current_span(), attributes)
+
+    def export(self, span):
+        line = json.dumps(span.to_dict(), default=str) + '\n'
+        with self._lock:
+            try:
+                if self._file is None:
+                    os.makedirs(os.path.dirname(self.path), exist_ok=True)
+                    self._file = open(self.path, 'a', buffering=1)
+                self._file.write(line)
+            except OSError as e:
+                self.log.warning("Unable to write the %s span to %s: %s", span.name, self.path, e)
+
+
+def current_span():
+    """
+    The span in progress, if any
+    """
+    if _current_span is None:
+        return None
+    return _current_span.get()
+
+
+def annotate(**attributes):
+    """
+    Add attributes to the span in progress, if any
+    """
+    span = current_span()
+    if span is not None:
+        span.attributes.update(attributes)
+
+
+def traced(name, attributes=None):
+    """
+    Record each call of a method which returns a future as a span
+
+    attributes is called with the same arguments as the method and returns the span's attributes.
+    Coroutines started by the method belong to the span, as long as they are started before the
+    method returns its future.
+    """
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            tracer = CarinaTracer.instance(config=self.config)
+            if not tracer.enabled:
+                return method(self, *args, **kwargs)
+
+            span = tracer.start_span(
+                name, attributes(self, *args, **kwargs) if attributes is not None else None)
+            token = _current_span.set(span)
+            try:
+                future = method(self, *args, **kwargs)
+            except Exception as e:
+                span.finish(e)
+                tracer.export(span)
+                raise
+            finally:
+                _current_span.reset(token)
+
+            def finish(future):
+                span.finish(future.exception())
+                tracer.export(span)
+            future.add_done_callback(finish)
+            return future
+
+        return wrapper
+
+    return decorator
@@ -13,8 +13,8 @@ import os
 import sys
 
 v = sys.version_info
-if v[:2] < (3,3):
-    error = "ERROR: Jupyter Hub requires Python version 3.3 or above."
+if v[:2] < (3,6):
+    error = "ERROR: jupyterhub-carina requires Python version 3.6 or above."
     print(error, file=sys.stderr)
     sys.exit(1)
 
@@ -0,0 +1,101 @@
+"""
+Run the tests against the fake Carina API in benchmarks/fake_carina.py
+"""
+import os
+import sys
+from time import time
+from types import SimpleNamespace
+from uuid import uuid4
+import pytest
+from tornado.ioloop import IOLoop
+from traitlets.config import Config
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                                'benchmarks'))
+from fake_carina import FakeCarina
+
+# CarinaOAuthClient reads the URL of the Carina API when it is imported
+_carina = FakeCarina(latency=0.01, ready_after=0.2, pull_duration=0.1)
+os.environ['CARINA_OAUTH_URL'] = _carina.listen_in_thread()
+
+
+@pytest.fixture
+def carina():
+    """
+    The fake Carina service, shared by all tests
+    Each test should use its own users, see the username fixture.
+    """
+    return _carina
+
+
+@pytest.fixture
+def username():
+    return 'user-' + uuid4().hex[:8]
+
+
+@pytest.fixture
+def run():
+    """
+    Run a coroutine function on the IO loop, and return its result
+    """
+    def run(coroutine, timeout=30):
+        return IOLoop.current().run_sync(coroutine, timeout=timeout)
+    return run
+
+
+@pytest.fixture
+def config(tmpdir):
+    c = Config()
+    c.CarinaAuthenticator.client_id = 'test'
+    c.CarinaAuthenticator.client_secret = 'test'
+    c.CarinaAuthenticator.oauth_callback_url = 'http://127.0.0.1:8000/hub/oauth_callback'
+    c.CarinaSpawner.credentials_root = str(tmpdir.mkdir('clusters'))
+    c.CarinaSpawner.container_image = 'jupyter/singleuser'
+    c.CarinaSpawner.cluster_polling_interval = 1
+    c.BackoffReadiness.initial_interval = 0.1
+    c.CarinaOAuthClient.http_backend = 'simple'
+    return c
+
+
+@pytest.fixture
+def carina_client(carina, username):
+    """
+    A Carina client for a new user, with valid tokens
+    """
+    from jupyterhub_carina.CarinaOAuthClient import CarinaOAuthClient
+
+    tokens = carina.issue_tokens(username)
+    client = CarinaOAuthClient('test', 'test', 'http://127.0.0.1:8000/hub/oauth_callback',
+                               user=username, http_backend='simple')
+    client.load_credentials(tokens['access_token'], tokens['refresh_token'],
+                            time() + tokens['expires_in'], tokens['expires_in'])
+    return client
+
+
+@pytest.fixture
+def started_spawner(run, config, username):
+    """
+    A spawner for a new user, whose server was started on a new cluster
+    """
+    from jupyterhub_carina import CarinaAuthenticator, CarinaSpawner
+
+    authenticator = CarinaAuthenticator(config=config)
+    handler = SimpleNamespace(get_argument=lambda argument, default=None: username)
+    user = SimpleNamespace(
+        name=username,
+        state={},
+        url='/user/{}/'.format(username),
+        server=SimpleNamespace(ip='', port=0, cookie_name='jupyter-hub-token-' + username,
+                               base_url='/user/{}/'.format(username)))
+    hub = SimpleNamespace(api_url='http://127.0.0.1:8081/hub/api', public_host='',
+                          base_url='/hub/', server=SimpleNamespace(base_url='/hub/'))
+
+    run(lambda: authenticator.authenticate(handler))
+    spawner = CarinaSpawner(user=user, hub=hub, authenticator=authenticator, config=config,
+                            api_token='test')
+    # JupyterHub 0.9 looks the server up on the spawner
+    spawner.server = user.server
+    run(lambda: authenticator.pre_spawn_start(user, spawner))
+    run(spawner.start)
+    return spawner
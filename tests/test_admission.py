@@ -0,0 +1,50 @@
+from types import SimpleNamespace
+import pytest
+from jupyterhub_carina.CarinaAdmission import CarinaAdmission, FifoLimiter, SpawnCancelled
+
+
+def holder(name):
+    return SimpleNamespace(user=SimpleNamespace(name=name))
+
+
+def test_cancelled_waiter_leaves_the_queue():
+    limiter = FifoLimiter(1)
+    first, second, third = holder('first'), holder('second'), holder('third')
+    assert limiter.acquire(first).done()
+    second_slot = limiter.acquire(second)
+    third_slot = limiter.acquire(third)
+
+    assert limiter.cancel(second)
+    with pytest.raises(SpawnCancelled):
+        second_slot.result()
+    assert limiter.position(second) == 0
+    assert limiter.position(third) == 1
+
+    # The slot goes to the next waiter, not the cancelled one
+    limiter.release()
+    assert third_slot.done() and third_slot.exception() is None
+    assert limiter.active == 1
+
+
+def test_cancelling_a_holder_which_is_not_waiting():
+    limiter = FifoLimiter(1)
+    running = holder('running')
+    limiter.acquire(running)
+
+    assert not limiter.cancel(running)
+    assert not limiter.cancel(holder('unknown'))
+    limiter.release()
+    assert limiter.active == 0
+
+
+def test_cancelled_spawn_does_not_hold_a_slot():
+    admission = CarinaAdmission(max_concurrent_spawns=1)
+    running, cancelled = holder('running'), holder('cancelled')
+    admission.acquire_spawn(running)
+    admission.acquire_spawn(cancelled)
+
+    admission.cancel_spawn(cancelled)
+    assert admission.queue_position(cancelled) == 0
+    admission.release_spawn()
+    assert admission.spawns.active == 0
+    assert admission.acquire_spawn(holder('next')).done()
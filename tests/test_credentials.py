@@ -0,0 +1,45 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+from jupyterhub_carina.CarinaCredentials import (
+    CREDENTIAL_FILES, credentials_complete, install_credentials, load_docker_config)
+
+
+def cluster_credentials(carina, username):
+    cluster = carina.create_cluster(username, 'jupyterhub')
+    return carina.credentials_zip(cluster)
+
+
+def test_install_credentials(tmpdir, carina, username):
+    install_credentials(cluster_credentials(carina, username), str(tmpdir))
+
+    assert os.listdir(str(tmpdir)) == ['jupyterhub']
+    assert credentials_complete(str(tmpdir.join('jupyterhub')))
+    assert load_docker_config(str(tmpdir.join('jupyterhub')))['DOCKER_HOST'].startswith('tcp://')
+
+
+def test_concurrent_installs_leave_complete_credentials(tmpdir, carina, username):
+    credentials_zip = cluster_credentials(carina, username)
+    with ThreadPoolExecutor(8) as executor:
+        list(executor.map(lambda _: install_credentials(credentials_zip, str(tmpdir)), range(8)))
+
+    # No staging directories are left behind
+    assert os.listdir(str(tmpdir)) == ['jupyterhub']
+    assert credentials_complete(str(tmpdir.join('jupyterhub')))
+
+
+def test_incomplete_credentials_are_replaced(tmpdir, carina, username):
+    tmpdir.mkdir('jupyterhub').join('docker.env').write('export DOCKER_HOST=tcp://old:2376\n')
+    install_credentials(cluster_credentials(carina, username), str(tmpdir))
+
+    assert sorted(os.listdir(str(tmpdir.join('jupyterhub')))) == sorted(CREDENTIAL_FILES)
+    assert 'old' not in tmpdir.join('jupyterhub', 'docker.env').read()
+
+
+def test_complete_credentials_are_kept(tmpdir, carina, username):
+    credentials_zip = cluster_credentials(carina, username)
+    install_credentials(credentials_zip, str(tmpdir))
+    tmpdir.join('jupyterhub', 'docker.env').write('export DOCKER_HOST=tcp://installed:2376\n')
+
+    install_credentials(credentials_zip, str(tmpdir))
+    assert 'installed' in tmpdir.join('jupyterhub', 'docker.env').read()
+    assert os.listdir(str(tmpdir)) == ['jupyterhub']
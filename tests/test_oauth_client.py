@@ -0,0 +1,83 @@
+import pytest
+from tornado import gen
+from tornado.httpclient import HTTPClientError
+from jupyterhub_carina.CarinaOAuthClient import CarinaOAuthClient
+
+
+def copy_client(client):
+    """
+    Another client with the same tokens, like the spawner's copy of a login's tokens
+    """
+    copy = CarinaOAuthClient(client.client_id, client.client_secret, client.callback_url,
+                             user=client.user, http_backend='simple')
+    credentials = client.credentials
+    copy.load_credentials(credentials.access_token, credentials.refresh_token,
+                          credentials.expires_at, credentials.lifetime)
+    return copy
+
+
+def test_concurrent_token_refreshes_share_one_request(run, carina, carina_client):
+    other = copy_client(carina_client)
+    issued = carina_client.credentials
+    token_requests = carina.calls[('POST', '/oauth/token')]
+
+    @gen.coroutine
+    def refresh():
+        return (yield [carina_client.refresh_tokens(), other.refresh_tokens(),
+                       carina_client.refresh_tokens()])
+    refreshed = run(refresh)
+
+    # The refresh token may only be used once
+    assert carina.calls[('POST', '/oauth/token')] - token_requests == 1
+    assert len({credentials.refresh_token for credentials in refreshed}) == 1
+    assert refreshed[0].refresh_token != issued.refresh_token
+    assert other.credentials.access_token == carina_client.credentials.access_token
+    run(carina_client.list_clusters)
+
+
+def test_failed_token_refresh_is_not_shared(run, carina, carina_client):
+    carina_client.load_credentials('invalid', 'invalid', 0)
+    for _ in range(2):
+        token_requests = carina.calls[('POST', '/oauth/token')]
+        with pytest.raises(HTTPClientError):
+            run(carina_client.refresh_tokens)
+        assert carina.calls[('POST', '/oauth/token')] - token_requests == 1
+
+
+def test_invalidated_listing_is_not_cached(run, monkeypatch, carina, carina_client):
+    request = carina_client.execute_oauth_request
+
+    @gen.coroutine
+    def slow_request(*args, **kwargs):
+        response = yield request(*args, **kwargs)
+        yield gen.sleep(0.3)
+        return response
+
+    @gen.coroutine
+    def create_while_listing():
+        monkeypatch.setattr(carina_client, 'execute_oauth_request', slow_request)
+        stale = carina_client.list_clusters()
+        yield gen.sleep(0.1)
+        monkeypatch.setattr(carina_client, 'execute_oauth_request', request)
+
+        # The listing has been sent, but not cached yet
+        carina.create_cluster(carina_client.user, 'new')
+        carina_client.invalidate_clusters()
+        return (yield stale), (yield carina_client.list_clusters())
+    stale, listing = run(create_while_listing)
+
+    assert 'new' not in stale
+    assert 'new' in listing
+
+
+def test_concurrent_listings_share_one_request(run, carina, carina_client):
+    carina.create_cluster(carina_client.user, 'existing')
+    listings = carina.calls[('GET', '/proxy/clusters')]
+
+    @gen.coroutine
+    def list_concurrently():
+        return (yield [carina_client.list_clusters() for _ in range(5)])
+    results = run(list_concurrently)
+
+    assert carina.calls[('GET', '/proxy/clusters')] - listings == 1
+    assert all('existing' in clusters for clusters in results)
@@ -0,0 +1,74 @@
+import ssl
+import pytest
+from tornado import web
+from fake_carina import PingHandler
+from jupyterhub_carina import CarinaSpawner
+from jupyterhub_carina.CarinaCredentials import DatabaseCredentialStorage
+
+
+@pytest.fixture
+def config(config, tmpdir):
+    """
+    Store the credentials in a database, where they outlive the local credentials directory
+    """
+    fernet = pytest.importorskip('cryptography.fernet')
+    config.CarinaSpawner.credential_storage_class = DatabaseCredentialStorage
+    config.DatabaseCredentialStorage.db_url = 'sqlite:///{}'.format(
+        tmpdir.join('credentials.sqlite'))
+    config.DatabaseCredentialStorage.encryption_key = fernet.Fernet.generate_key().decode()
+    return config
+
+
+def certificate_rejection():
+    error = ssl.SSLError(1, "[SSL: SSLV3_ALERT_BAD_CERTIFICATE] sslv3 alert bad certificate")
+    error.reason = 'SSLV3_ALERT_BAD_CERTIFICATE'
+    return error
+
+
+def test_listed_cluster_which_failed_verification_is_not_gone(run, started_spawner):
+    error = ssl.SSLCertVerificationError(1, "[SSL: CERTIFICATE_VERIFY_FAILED] "
+                                            "certificate verify failed")
+    assert not run(lambda: started_spawner.cluster_is_gone(error))
+
+
+def test_listed_cluster_which_rejected_the_certificate_is_gone(run, started_spawner):
+    assert run(lambda: started_spawner.cluster_is_gone(certificate_rejection()))
+
+
+def test_listed_cluster_which_did_not_respond_is_not_gone(run, started_spawner):
+    assert not run(lambda: started_spawner.cluster_is_gone(ConnectionRefusedError()))
+
+
+def test_deleted_cluster_is_gone(run, carina, started_spawner):
+    del carina.clusters[started_spawner.user.name][started_spawner.cluster_name]
+    assert run(lambda: started_spawner.cluster_is_gone(ConnectionRefusedError()))
+
+
+def test_replaced_cluster_is_gone(run, carina, started_spawner):
+    carina.create_cluster(started_spawner.user.name, started_spawner.cluster_name)
+    assert run(lambda: started_spawner.cluster_is_gone(ConnectionRefusedError()))
+
+
+def test_unresponsive_cluster_keeps_its_stored_credentials(run, monkeypatch, started_spawner):
+    def unavailable(handler):
+        raise web.HTTPError(500)
+    monkeypatch.setattr(PingHandler, 'get', unavailable)
+    CarinaSpawner._cluster_liveness.clear()
+    started_spawner.cluster_record = None
+
+    user, cluster_name = started_spawner.user.name, started_spawner.cluster_name
+    assert not run(started_spawner.cluster_exists)
+    assert run(lambda: started_spawner.credential_storage.load_async(user, cluster_name))
+
+
+def test_deleted_cluster_loses_its_stored_credentials(run, monkeypatch, carina, started_spawner):
+    def unavailable(handler):
+        raise web.HTTPError(500)
+    monkeypatch.setattr(PingHandler, 'get', unavailable)
+    CarinaSpawner._cluster_liveness.clear()
+    started_spawner.cluster_record = None
+    carina.clusters[started_spawner.user.name].clear()
+
+    user, cluster_name = started_spawner.user.name, started_spawner.cluster_name
+    assert not run(started_spawner.cluster_exists)
+    assert run(lambda: started_spawner.credential_storage.load_async(user, cluster_name)) is None